@@ -3,10 +3,18 @@
 # make sure to read src/backend/README.md if this confuses you.
 
 import sys
+import os
+import binascii
 from os.path import dirname, abspath, join as pathjoin
 
 import json
 
+import numpy
+try:
+   import msgpack
+except ImportError: #then we only speak JSON
+   msgpack = None
+
 from twisted.internet import reactor
 from twisted.internet import task
 from twisted.python import log
@@ -15,6 +23,7 @@ from twisted.web.static import File
 from twisted.internet.defer import inlineCallbacks
 
 from autobahn.twisted.websocket import WebSocketServerFactory, WebSocketServerProtocol
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
 from autobahn.twisted.resource import WebSocketResource
 
 #'working directory': not the system working directory, but the directory this program is in (so that we can be run from anywhere and find the correct assets/ folder et al.)
@@ -39,24 +48,96 @@ import eutopia   #this is actually sitting in ../models/, but is symlinked into
 # ah, simpler: reactor.callLater
 # useful: <https://twistedmatrix.com/documents/current/core/howto/time.html>
 
+######################
+## Wire formats
+
+# A client picks the format by asking for its WebSocket subprotocol, eg new WebSocket(url, ["eutopia.msgpack", "eutopia.json"]);
+# clients which don't ask get JSON. Messages are the same either way; only their encoding differs.
+
+class JSONCodec(object):
+   "text frames of JSON; NumPy arrays go as lists"
+   subprotocol = "eutopia.json"
+   binary = False
+
+   def _default(self, o):
+      if isinstance(o, numpy.ndarray):
+         return o.tolist()
+      if isinstance(o, numpy.generic):
+         return o.item()
+      raise TypeError("%r is not JSON serializable" % (o,))
+
+   def encode(self, message):
+      return json.dumps(message, default=self._default)
+
+   def decode(self, payload):
+      return json.loads(payload)
+
+class MsgpackCodec(object):
+   """
+   binary frames of MessagePack.
+   NumPy arrays go as flat, little-endian typed arrays: MessagePack extension type i+1 is ARRAY_TYPES[i],
+   so that the client can view the extension's bytes as the matching TypedArray without copying them.
+   """
+   subprotocol = "eutopia.msgpack"
+   binary = True
+   ARRAY_TYPES = ['|u1', '<u2', '<u4', '|i1', '<i2', '<i4', '<f4', '<f8'] #(Uint8Array ... Float64Array; there's no Int64Array, so int64s are narrowed to int32s)
+
+   def _default(self, o):
+      if isinstance(o, numpy.ndarray):
+         dtype = o.dtype.newbyteorder('<').str if o.dtype.itemsize > 1 else o.dtype.str
+         if dtype == '<i8': dtype = '<i4'
+         if dtype == '<u8': dtype = '<u4'
+         if dtype == '|b1': dtype = '|u1'
+         if dtype not in self.ARRAY_TYPES:
+            raise TypeError("Can't pack arrays of %s" % (o.dtype,))
+         return msgpack.ExtType(self.ARRAY_TYPES.index(dtype) + 1, numpy.ascontiguousarray(o, dtype=dtype).tostring())
+      if isinstance(o, numpy.generic):
+         return o.item()
+      raise TypeError("%r is not MessagePack serializable" % (o,))
+
+   def encode(self, message):
+      return msgpack.packb(message, default=self._default) #(py2 strs go as msgpack strs; only arrays are binary)
+
+   def decode(self, payload):
+      return msgpack.unpackb(payload, encoding='utf-8')
+
+JSON = JSONCodec()
+CODECS = dict((codec.subprotocol, codec) for codec in [JSON] + ([MsgpackCodec()] if msgpack else []))
+
 ######################
 ## Twisted Components
 
+class CodecProtocol(WebSocketServerProtocol):
+   "a WebSocket connection which speaks whichever of CODECS the client asks for first (by subprotocol), or else JSON"
+   codec = JSON
+
+   def onConnect(self, request):
+      for subprotocol in request.protocols:
+         if subprotocol in CODECS:
+            self.codec = CODECS[subprotocol]
+            return subprotocol
+
+   def send(self, message):
+      "encode and send one message"
+      self.sendMessage(self.codec.encode(message), self.codec.binary)
+
 #TODO(kousu): move this out to scratch/ for reference on how to host a web socket server using AutobahnPython
-class CtlProtocol(WebSocketServerProtocol):
+class CtlProtocol(CodecProtocol):
    def onConnect(self, request):
       print("Client connecting: {}".format(request.peer))
+      return CodecProtocol.onConnect(self, request)
 
    def onOpen(self):
       print("WebSocket connection open.")
       
    def onMessage(self, payload, isBinary):
-      if isBinary:
-        print("This is probably bad. Binary message received: {} bytes.".format(len(payload)))
+      if isBinary != self.codec.binary:
+        print("This is probably bad. {} message received over {}: {} bytes.".format("Binary" if isBinary else "Text", self.codec.subprotocol, len(payload)))
       else:
-        print("Text message received: |{}|".format(payload.decode('utf8')))
+        if not isBinary:
+          print("Text message received: |{}|".format(payload.decode('utf8')))
         try:
-          payload = json.loads(payload)
+          payload = self.codec.decode(payload)
         except ValueError, e:
           payload = {}
  
@@ -76,8 +157,10 @@ class CtlProtocol(WebSocketServerProtocol):
         elif message == 'setInterventions':
           # delete all interventions in the intervention list
           del model.interventions[:]
-          # clean up the log 
-          del model.log[:]
+          # and let go of any worker processes (they are forked again, from the new state, when the model next steps)
+          model.close()
+          # clean up the log (and tell the viewers to)
+          data_endpoint.broadcaster.clear()
           # add all the new interventions
           for intervention in payload['content']['interventions']:
             # FIXME change the names of the arguments to PriceIntervention to match those of the frontend, or vice versa. 
@@ -86,38 +169,173 @@ class CtlProtocol(WebSocketServerProtocol):
             product = intervention['activity']
             time = intervention['year']
             scale = intervention['tax_value']
-            model.intervene(PriceIntervention(time, product, scale))
+            model.intervene(eutopia.PriceIntervention(time, product, scale))
 
 
 
    def onClose(self, wasClean, code, reason):
       print("WebSocket connection closed: {}".format(reason))
 
-class ModelDataServer(WebSocketServerProtocol):
+def delta(previous, current):
+   "the {name: count} in current which differ from previous, with 0 for names that are only in previous"
+   changes = dict((name, count) for name, count in current.items() if previous.get(name) != count)
+   changes.update((name, 0) for name in previous if name not in current)
+   return changes
+
+class Broadcaster(object):
+   """
+   fans each new step of the model out to every connected ModelDataServer.
+   The model calls step() itself after it steps (see Eutopia.listen()), so there is no polling
+   and nothing to do while it is idle, and each step is encoded and framed once, however many viewers there are.
+   (Except for farm frames to viewers that negotiated permessage-deflate: see broadcast().)
+
+   Every message is {"run": r, "seq": n, "steps": [[time, counts], ...]}, where n is the sequence number of the last step in it.
+   Steps are numbered from 1 and the numbers keep going up when the log is cleared, so a viewer
+   that remembers the last number it saw can pick up from there (see catch_up()).
+   r is a random token, new each time the server starts and each time the log is cleared, so that a viewer picking up
+   from a number can tell whether it is from this run of the log at all (see catch_up()).
+   A message with "reset": true means the log was started over, and what came before it should be dropped.
+
+   Except: most steps are broadcast as {"run": r, "seq": n, "delta": [time, changes]} instead, where changes holds only the
+   counts which differ from step n-1's (0 for activities which stopped), so a viewer has to have step n-1 to use it.
+   Every KEYFRAME_INTERVAL'th step (and the first after the log is cleared) is sent whole, and catch-ups are always whole.
+
+   Viewers which ask for them (see ModelDataServer) also get what every farm is doing, after each step's message:
+   either {"run": r, "seq": n, "farms": <uint8 array>, "activities": [names]}, the whole Eutopia.activity_frame(),
+   in the map's feature order, in which farms are the codes of their activities in `activities`,
+   or {"run": r, "seq": n, "changed": [<uint32 array of features>, <uint8 array of their new codes>]}, for just the farms
+   which changed since step n-1, when that is smaller. The same KEYFRAME_INTERVAL applies, and a whole frame is also
+   sent whenever there are activities whose names haven't been sent yet (eg after a NewActivityIntervention).
+   Over msgpack, the arrays are typed arrays (see MsgpackCodec), so 10000 farms are about 10KB.
+   """
+   KEYFRAME_INTERVAL = 20
+
+   def __init__(self, factory, model):
+      self.factory = factory
+      self.model = model
+      self.viewers = set()
+      self.base = 0 #the sequence number of the step before model.log[0]
+      self.frame = None #the last activity frame sent, if anyone is watching the farms
+      self.frame_codes = 0 #how many activity codes there were when the last whole frame (and its names) was sent
+      self.run = self.new_run()
+      model.listen(self.step)
+
+   @staticmethod
+   def new_run():
+      return binascii.hexlify(os.urandom(8))
+
+   @property
+   def seq(self):
+      "the sequence number of the last step"
+      return self.base + len(self.model.log)
+
+   def header(self):
+      "the fields every message starts with"
+      return {"run": self.run, "seq": self.seq}
+
+   def message(self, steps, reset=False):
+      message = self.header()
+      message["steps"] = steps
+      if reset:
+         message["reset"] = True
+      return message
+
+   def broadcast(self, message, viewers=None, compress=False):
+      """
+      send message to every viewer (or every one of `viewers`), encoding it once for each codec in use.
+      Uncompressed, it is framed once too. But a compressed message has to be deflated separately for each viewer
+      which negotiated permessage-deflate (their compressors each have their own state), so autobahn frames it once per viewer;
+      that is only worth it for big messages (ie farm frames), so the rest go out uncompressed even to those viewers.
+      """
+      prepared = {}
+      for viewer in (self.viewers if viewers is None else viewers):
+         if viewer.codec not in prepared:
+            prepared[viewer.codec] = self.factory.prepareMessage(viewer.codec.encode(message), viewer.codec.binary, doNotCompress=not compress)
+         viewer.sendPreparedMessage(prepared[viewer.codec])
+
+   def step(self, model):
+      if not model.log:
+         return
+      if len(model.log) < 2 or self.seq % self.KEYFRAME_INTERVAL == 0:
+         self.broadcast(self.message([model.log[-1]]))
+      else:
+         (_, previous), (time, counts) = model.log[-2:]
+         message = self.header()
+         message["delta"] = [time, delta(previous, counts)]
+         self.broadcast(message)
+      self.step_farms(model)
+
+   def farms_message(self, frame):
+      self.frame_codes = len(self.model.codes)
+      message = self.header()
+      message.update(farms=frame, activities=self.model.codes.names)
+      return message
+
+   def step_farms(self, model):
+      viewers = [viewer for viewer in self.viewers if viewer.farms]
+      if not viewers:
+         self.frame = None
+         return
+      frame = model.activity_frame()
+      changed = None if self.frame is None else numpy.flatnonzero(frame != self.frame).astype(numpy.uint32)
+      if (changed is None or self.seq % self.KEYFRAME_INTERVAL == 0
+          or len(self.model.codes) > self.frame_codes #new activities: the viewers need their names
+          or 5*len(changed) >= len(frame)): #(a changed farm costs 5 bytes; the whole frame, 1 byte a feature)
+         self.broadcast(self.farms_message(frame), viewers, compress=True)
+      else:
+         message = self.header()
+         message["changed"] = [changed, frame[changed]]
+         self.broadcast(message, viewers, compress=True)
+      self.frame = frame
+
+   def catch_up(self, viewer, since, run=None):
+      "send viewer, in one message, every step after step number `since` of run `run`"
+      "if that is some other run (eg from before the server restarted or the log was last cleared), that's all of the log, with a reset"
+      reset = run != self.run or not (self.base <= since <= self.seq)
+      steps = self.model.log[(0 if reset else since - self.base):]
+      if steps or reset:
+         viewer.send(self.message(steps, reset))
+      if viewer.farms:
+         # everyone else watching the farms already has the current frame, if there is anyone
+         self.frame = self.model.activity_frame() if self.frame is None else self.frame
+         viewer.send(self.farms_message(self.frame))
+
+   def clear(self):
+      "start the log over (eg when the interventions change), and tell the viewers to as well"
+      self.base = self.seq
+      self.run = self.new_run()
+      del self.model.log[:]
+      self.broadcast(self.message([], reset=True))
+
+class ModelDataServer(CodecProtocol):
    """
    a connection serving timeseries data from Eutopia.
    self.factory.model is Eutopia and is shared amongst
-   all "Viewer" ModelDataServers.
+   all "Viewer" ModelDataServers; self.factory.broadcaster sends them each step as it happens.
+
+   A viewer connecting to /ws?since=<seq>&run=<run> gets the steps after <seq> (eg the last one it saw
+   before it lost its connection), if <run> is still the current run; otherwise, or connecting to plain /ws,
+   it gets every step so far (with a reset).
+   Either way, the backlog comes all at once, in one message.
+   A viewer connecting with ?farms=1 also gets every farm's activity, every step (see Broadcaster).
    """
+   farms = False
+
+   def onConnect(self, request):
+      try:
+         self.since = int(request.params.get('since', [0])[0])
+      except ValueError:
+         self.since = 0
+      self.run = request.params.get('run', [None])[0]
+      self.farms = request.params.get('farms', ['0'])[0] not in ('', '0')
+      return CodecProtocol.onConnect(self, request)
+
    def onOpen(self):
-      self.time = self.factory.model.time #stash the time we started watching the model at
-      model = self.factory.model
-      def push():
-          "this function essentially polls for new data"
-          "using select() or events would be better"  
-          if self.time < len(model.log):
-              #TODO: if we are much behind where model is, do we want to batch all the updates at once?
-              #  - i like it the way it is now for debugging as we get settled into the new stream, since the model and the data are running at different rates and will therefore get out of sync
-              J = model.log[self.time]
-              print "pushing", J, "to", self.peer #debug
-              self.sendMessage(json.dumps(J))
-              self.time+=1
-      
-      self.push = task.LoopingCall(push)
-      self.push.start(0.06)
+      self.factory.broadcaster.catch_up(self, self.since, self.run)
+      self.factory.broadcaster.viewers.add(self)
    
    def onClose(self, *args):
-      self.push.stop()
+      self.factory.broadcaster.viewers.discard(self)
 
 
 #######################
@@ -131,17 +349,27 @@ if __name__ == '__main__':
       log.startLogging(sys.stdout)
       print "Starting server in", PROJECT_ROOT
    
-   model = eutopia.Eutopia([]) #the [] becomes model.log
+   model = eutopia.Eutopia(eutopia.MetricsLog(), batch=True) #the MetricsLog becomes model.log; batched, so a step is a few NumPy operations, and columnar (which batch implies), so activity frames come straight from the state arrays
    #model = eutopia.create_demo_model()
    poke_model = task.LoopingCall(lambda: next(model))
    #poke_model.start(4) #4 second intervals
    
+   def accept_deflate(offers):
+      "compress (with permessage-deflate) whenever the browser offers to"
+      "(only farm frames and catch-ups are actually compressed; see Broadcaster.broadcast())"
+      for offer in offers:
+         if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+
    data_endpoint = WebSocketServerFactory()
    data_endpoint.protocol = ModelDataServer
    data_endpoint.model = model
+   data_endpoint.broadcaster = Broadcaster(data_endpoint, model)
+   data_endpoint.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
    
    ctl_endpoint = WebSocketServerFactory()
    ctl_endpoint.protocol = CtlProtocol
+   ctl_endpoint.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
       
    webroot = pathjoin(PROJECT_ROOT,"src","frontend")
    assets = pathjoin(PROJECT_ROOT,"assets")
@@ -11,6 +11,46 @@ $(document).ready(function() {
     };
 
     // the data websocket
-    Game.dataSocket = new WebSocket("ws://" + location.host + "/ws"); //our websocket sits at /ws (TODO(kousu): reorg this)
+    // each message is {seq: <the number of its last step>, steps: [[time, counts], ...]}, plus reset: true if the run started over;
+    // we remember the last seq we saw so that, if the connection drops, we can reconnect and pick up where we left off
+    // most steps come as {seq: ..., delta: [time, <just the counts that changed>]}, which we turn back into whole steps here
+    Game.dataSeq = 0;
+    Game.dataRun = ""; //the run Game.dataSeq is from; the server resets us if it has started a new one
+    Game.dataCounts = {}; //the counts at step Game.dataSeq
+    Game.onData = function(message) {}; //set by graph.js
+    function connectData() {
+      Game.dataSocket = new WebSocket("ws://" + location.host + "/ws?since=" + Game.dataSeq + "&run=" + Game.dataRun); //our websocket sits at /ws (TODO(kousu): reorg this)
+      Game.dataSocket.onmessage = function(e) {
+        var message = JSON.parse(e.data);
+        if(message.reset) {
+          Game.dataCounts = {};
+        }
+        if(message.delta) {
+          if(message.seq != Game.dataSeq + 1) { //we missed a step, so can't use this; reconnecting catches us up
+            Game.dataSocket.close();
+            return;
+          }
+          var counts = $.extend({}, Game.dataCounts);
+          for(var key in message.delta[1]) {
+            if(message.delta[1][key]) {
+              counts[key] = message.delta[1][key];
+            } else {
+              delete counts[key];
+            }
+          }
+          message.steps = [[message.delta[0], counts]];
+        }
+        if(message.steps.length) {
+          Game.dataCounts = message.steps[message.steps.length-1][1];
+        }
+        Game.dataSeq = message.seq;
+        Game.dataRun = message.run;
+        Game.onData(message);
+      };
+      Game.dataSocket.onclose = function() {
+        setTimeout(connectData, 1000);
+      };
+    }
+    connectData();
 
 });
\ No newline at end of file
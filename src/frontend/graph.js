@@ -51,17 +51,21 @@ $(function() {
     return chart;
   });
 
-  Game.dataSocket.onmessage = function(d) {
-    //console.log("received data from (plain) websocket:", d)
-    d = JSON.parse(d.data);
-    var time = d[0]
-    var series = d[1]
-    //d.date = parseDate(d.date);
-    
-    //loop through and format data into line graph data for nv
-    for(key in series) {
-      addData(key, time, [series[key]]);
-    }      
+  Game.onData = function(message) {
+    //console.log("received data from (plain) websocket:", message)
+    if(message.reset) {
+      scope.data.length = 0;
+    }
+    for(var i = 0; i < message.steps.length; i++) {
+      var time = message.steps[i][0]
+      var series = message.steps[i][1]
+      //d.date = parseDate(d.date);
+      
+      //loop through and format data into line graph data for nv
+      for(key in series) {
+        addData(key, time, [series[key]]);
+      }
+    }
 
     // update the chart with the data
     svg.datum(scope.data)
@@ -12,8 +12,12 @@ from .eutopia import *
 # (and server.py)) is generic enough.
 from .simulation import *
 
+# Monte Carlo studies over many runs of a scenario
+from .ensemble import *
+
 # now, we explicitly hide the irrelevant helper modules
 # from "from eutopia import *" lines:
 __all__   =  []
 __all__  +=  eutopia.__all__ 
 __all__  +=  simulation.__all__
+__all__  +=  ensemble.__all__
@@ -30,14 +30,31 @@ activities = {
     }    
    
 import random   
+
+import numpy
+
+import rng
+
+# what a draw is for, as part of its key: what a farm expects an activity to make
+# and what the activity actually makes it are independent draws
+EXPECTED, ACTUAL = 0, 1
+
 class Normal:
     def __init__(self, mean, sd):
         self.mean = mean
         self.sd = sd
-    def value(self):
-        return random.gauss(self.mean, self.sd)
+    def value(self, key=None):
+        "draw a value; if a key (hashed with rng.digest()) is given, it comes from the counter-based generator in rng.py,"
+        "so the same key always gives the same value"
+        if key is None:
+            return random.gauss(self.mean, self.sd)
+        return self.mean + self.sd*rng.normal_of(key)
     def __mul__(self, scale):
         return Normal(self.mean*scale, self.sd*scale)
+    def __eq__(self, other):
+        return isinstance(other, Normal) and (self.mean, self.sd) == (other.mean, other.sd)
+    def __ne__(self, other):
+        return not self == other
         
         
 
@@ -65,26 +82,155 @@ class Activity:
         self.products = products
         self.aggregate_measures = aggregate_measures
     
-    def get_product(self, key, farm):
-        if key in self.products.keys():
+    def get_product(self, key, farm, draw=None):
+        "draw is an optional hashed key prefix for the random draws, eg rng.digest(seed, time, farm id, EXPECTED); see Normal.value()"
+        "(the model itself uses Coefficients.get_product(), which gives the same values without looking anything up)"
+        if key in self.products:
             return self.products[key]*farm.area
-        elif key in self.aggregate_measures.keys():
+        elif key in self.aggregate_measures:
+            if draw is not None: draw = rng.extend(draw, key, self.name)
             total = 0
-            for item, distribution in self.aggregate_measures[key].items():
-                if item in self.products.keys():
-                    weight = distribution.value()
+            # in a fixed order, so the total rounds the same whichever order the dict (eg a restored snapshot's) has
+            for item, distribution in sorted(self.aggregate_measures[key].items()):
+                if item in self.products:
+                    weight = distribution.value(None if draw is None else rng.extend(draw, item))
                     total += weight*self.products[item]*farm.area
             return total
     
         raise Exception('Could not find product "%s"'%key)
 
-class Activities:
+class Coefficients(object):
+    """
+    The activities and aggregate measures of an Activities, compiled into matrices:
+      products:          every product, sorted; the rows of quantity
+      measures:          every aggregate measure, sorted
+      quantity[p,a]:     how much of product p activity a makes per unit area (0 if it doesn't)
+      makes[p,a]:        whether activity a lists product p at all (even as 0, which still takes a draw)
+    and, per measure and activity, the (item, mean, sd, quantity) terms Activity.get_product() sums, so that
+    scoring doesn't look anything up in the activities' dicts.
+    Build one with Activities.coefficients, which keeps it up to date.
+    """
+    def __init__(self, activities, aggregates):
+        self.names = [a.name for a in activities]
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.products = sorted(set(p for a in activities for p in a.products) | set(p for m in aggregates.values() for p in m))
+        self.measures = sorted(aggregates)
+        self._rows = dict((p, i) for i, p in enumerate(self.products)) #product -> its row of quantity
+
+        self.quantity = numpy.zeros((len(self.products), len(activities)))
+        self.makes = numpy.zeros((len(self.products), len(activities)), dtype=bool)
+        for a, activity in enumerate(activities):
+            for product, quantity in activity.products.items():
+                self.quantity[self._rows[product],a] = quantity
+                self.makes[self._rows[product],a] = True
+
+        self._items = {} #measure -> its [(item, mean, sd)], in Activity.get_product()'s order
+        for measure in self.measures:
+            self._items[measure] = [(item, d.mean, d.sd) for item, d in sorted(aggregates[measure].items())]
+
+        # the terms of get_product(key, a, ...): a number (for products the activity makes directly) or a list of
+        # (item, mean, sd, quantity) (for aggregate measures); python floats, which are faster than numpy's one at a time
+        self._terms = {}
+        for a, activity in enumerate(activities):
+            for measure in self.measures:
+                if measure not in activity.products:
+                    self._terms[measure, a] = [(item, mean, sd, float(activity.products[item]))
+                                               for item, mean, sd in self._items[measure] if item in activity.products]
+            for product, quantity in activity.products.items():
+                self._terms[product, a] = quantity
+        self._batch = {} #key -> terms(key)
+
+    def _direct(self, key):
+        "(which activities make key directly, how much of it they make); the others have to get it from the aggregate measure `key`"
+        if key in self._rows:
+            direct, quantity = self.makes[self._rows[key]], self.quantity[self._rows[key]]
+        else:
+            direct, quantity = numpy.zeros(len(self.names), dtype=bool), numpy.zeros(len(self.names))
+        if key not in self._items and not direct.all():
+            raise Exception('Could not find product "%s"'%key)
+        return direct, quantity
+
+    def get_product(self, key, a, area, draw=None):
+        "Activity.get_product(key, farm, draw) of the a'th activity, for a farm of the given area"
+        try:
+            terms = self._terms[key, a]
+        except KeyError:
+            raise Exception('Could not find product "%s"'%key)
+        if not isinstance(terms, list):
+            return terms*area
+        if draw is not None: draw = rng.extend(draw, key, self.names[a])
+        total = 0
+        for item, mean, sd, quantity in terms:
+            if draw is None:
+                weight = random.gauss(mean, sd)
+            else:
+                weight = mean + sd*rng.normal_of(rng.extend(draw, item))
+            total += weight*quantity*area
+        return total
+
+    def terms(self, key):
+        """
+        get_product(key) for every activity at once, as arrays:
+        returns (items, mean, sd, quantity, activity_keys), where mean and sd are per-item and quantity is (items, activities),
+        such that, for activity a, get_product(key, a, area) is
+           sum over items i of (mean[i] + sd[i]*z) * quantity[i,a] * area
+        with each z drawn independently from N(0,1) (keyed by key, activity_keys[a] and items[i], as get_product() keys them).
+        Item 0 stands for `key` itself, for activities which make `key` directly (these have no noise).
+        """
+        if key not in self._batch:
+            direct, direct_quantity = self._direct(key)
+            items = self._items.get(key, [])
+            mean = numpy.array([1.0] + [mean for _, mean, _ in items])
+            sd = numpy.array([0.0] + [sd for _, _, sd in items])
+
+            quantity = numpy.zeros((len(items)+1, len(self.names)))
+            quantity[0] = numpy.where(direct, direct_quantity, 0)
+            if items: #(an activity that makes key directly doesn't count it as a measure)
+                quantity[1:] = numpy.where(direct, 0, self.quantity[[self._rows[item] for item, _, _ in items]])
+
+            activity_keys = numpy.array([rng.key(name) for name in self.names], dtype=numpy.uint64)
+            self._batch[key] = ([key] + [item for item, _, _ in items], mean, sd, quantity, activity_keys)
+        return self._batch[key]
+
+class Activities(object):
+    """
+    the activities farms can choose between, and the aggregate measures (eg 'money') they are scored by.
+    Change them with add() and set_measure(), so that the compiled coefficients are kept up to date.
+    """
     def __init__(self):
-        self.aggregates = dict(aggregate_measures)
+        # copy each measure too: interventions (eg PriceIntervention) change these,
+        # and must not leak into other models in the same process (eg an ensemble's replicates)
+        self.aggregates = dict((key, dict(items)) for key, items in aggregate_measures.items())
         
         self.activities = []
         for name, data in activities.items():
             self.activities.append(Activity(name, aggregate_measures=self.aggregates, **data))
+        self.version = 0 #bumped by every change; see coefficients
+        self._coefficients = None #(version, Coefficients)
+
+    def add(self, activity):
+        "add a new Activity"
+        self.activities.append(activity)
+        self.version += 1
+
+    def set_measure(self, measure, item, distribution):
+        "change the distribution of the weight of `item` in aggregate measure `measure`, eg a price in 'money'"
+        if self.aggregates[measure].get(item) != distribution: #(interventions set their prices every step, mostly to the same thing)
+            self.aggregates[measure][item] = distribution
+            self.version += 1
+
+    @property
+    def coefficients(self):
+        "the Coefficients of the current activities and measures; only recompiled after they change"
+        if self._coefficients is None or self._coefficients[0] != self.version:
+            self._coefficients = (self.version, Coefficients(self.activities, self.aggregates))
+        return self._coefficients[1]
+
+    def __getstate__(self):
+        "don't pickle (eg into a snapshot) the compiled coefficients; they are rebuilt when next needed"
+        state = dict(self.__dict__)
+        state['_coefficients'] = None
+        return state
     
 if __name__=='__main__':
     activities = Activities()
@@ -0,0 +1,126 @@
+"""
+batched planting decisions for Eutopia.
+
+FarmFamily.make_planting_decision() scores every activity for one farm at a time,
+drawing each price one sample at a time. step() here makes the same decision for every farm
+at once: it builds a farms x activities score matrix with NumPy, drawing all the price
+noise for a block of farms at a time, and takes the argmax of each row.
+
+This needs the columnar state (Eutopia(columnar=True)); Eutopia(batch=True) turns both on.
+
+A step is split into prepare() (the small inputs shared by every decision), decide() (one block
+of farms; blocks are independent, so they can be run anywhere, in any order, see parallel.py) and apply().
+Noise comes from the counter-based generator in rng.py, keyed by farm, so the results only
+depend on the seed: they are the same as the per-farm loop's, however the blocks are scheduled.
+"""
+
+import numpy
+
+import rng
+from activity import EXPECTED, ACTUAL
+
+__all__ = ["BLOCK_SIZE", "sample_products", "shares", "Inputs", "prepare", "blocks", "decide", "apply", "step"]
+
+BLOCK_SIZE = 4096 #farms per block; this bounds the size of the score and noise arrays
+
+def sample_products(terms, area, draw, choice=None):
+    """
+    draw Activity.get_product() for farms of the given areas, all at once.
+    draw is the hashed key prefix of each farm's draws, rng.digest(seed, time, farm id, purpose), as an array
+
+    gives an (farms, activities) array, or, if `choice` gives an activity (column) for each farm, just the (farms,) values for those
+    """
+    items, mean, sd, quantity, activity_keys = terms
+    if choice is None:
+        draw, area, activity_keys = draw[:,None], area[:,None], activity_keys[None,:]
+    else:
+        quantity, activity_keys = quantity[:,choice], activity_keys[choice]
+    draw = rng.extend(draw, items[0], activity_keys)
+
+    # add up the items one at a time, in the same order as Activity.get_product(), so the sums come out exactly the same
+    total = 0
+    for i, item in enumerate(items):
+        weight = mean[i] + sd[i]*rng.normal_of(rng.extend(draw, item))
+        total = total + weight*quantity[i]*area
+    return total
+
+def shares(counts):
+    "normalize activity counts (rows of `counts`) to fractions of the total, leaving all-zero rows at 0"
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    total = counts.sum(axis=-1)
+    return counts / numpy.where(total > 0, total, 1)[...,None]
+
+class Inputs(object):
+    "the inputs every planting decision in a step shares; small, so cheap to send to other processes"
+    def __init__(self, seed, time, columns, ncodes, society, preferences, terms, money):
+        self.seed = seed               #the run's seed, which keys every random draw
+        self.time = time
+        self.columns = columns         #the activity code of each column of the score matrix
+        self.ncodes = ncodes           #how many activity codes there are
+        self.society = society         #the share of farms doing each activity
+        self.preferences = preferences #the order to score preferences in
+        self.terms = terms             #pref -> Coefficients.terms(pref), for preferences that are products
+        self.money = money             #Coefficients.terms('money'), which is what farms get paid in
+
+def prepare(eutopia):
+    "gather the shared inputs for this step's decisions"
+    farms, families = eutopia.state, eutopia.family_state
+    activities = eutopia.activities.activities
+    coefficients = eutopia.activities.coefficients #(in the same order as activities)
+    columns = numpy.array([farms.codes.code(a) for a in activities], dtype=numpy.intp) #interns any new activities
+    eutopia.counts.grow() #make room for any newly interned activities
+
+    terms = dict((pref, coefficients.terms(pref)) for pref in families.preferences
+                 if pref not in ('follow_society', 'follow_local'))
+    return Inputs(eutopia.seed, eutopia.time, columns, len(farms.codes),
+                  shares(eutopia.counts.total)[columns], list(families.preferences),
+                  terms, coefficients.terms('money'))
+
+def blocks(n, start=0, stop=None):
+    "the (block number, rows) of the blocks covering farms [start, stop), where start and stop are on block boundaries"
+    if stop is None: stop = n
+    for block in range(start // BLOCK_SIZE, (stop + BLOCK_SIZE - 1) // BLOCK_SIZE):
+        yield block, slice(block*BLOCK_SIZE, min((block+1)*BLOCK_SIZE, n))
+
+def decide(eutopia, inputs, block, rows, local):
+    """
+    make the planting decisions of the farms in slice `rows` (which must be block number `block`),
+    given `local`, the activity counts (by code) of those farms' neighbourhoods at the start of the step.
+
+    returns (choice, money): the column of inputs.columns each farm chose and the money that made it
+    """
+    farms, families = eutopia.state, eutopia.family_state
+    area = farms.area[rows]
+    family = farms.family[rows]
+    expected = rng.digest(inputs.seed, inputs.time, farms.id[rows], EXPECTED)
+
+    # score every activity for every farm
+    total = numpy.zeros((len(area), len(inputs.columns)))
+    for pref in inputs.preferences:
+        weight = families.weights[pref][family][:,None]
+        if pref == 'follow_society':
+            total += inputs.society * weight
+        elif pref == 'follow_local':
+            total += shares(local)[:,inputs.columns] * weight
+        else:
+            total += sample_products(inputs.terms[pref], area, expected) * weight
+
+    choice = total.argmax(axis=1) #like the per-farm loop, ties go to the earlier activity
+    return choice, sample_products(inputs.money, area, rng.digest(inputs.seed, inputs.time, farms.id[rows], ACTUAL), choice)
+
+def apply(eutopia, inputs, choice, money):
+    "move every farm to the activity it chose and pay its family"
+    farms, families = eutopia.state, eutopia.family_state
+    previous = farms.activity.copy()
+    farms.activity[:] = inputs.columns[choice]
+    eutopia.counts.change(numpy.arange(len(farms)), previous, farms.activity)
+    families.balance += numpy.bincount(farms.family, weights=money, minlength=len(families))
+
+def step(eutopia):
+    "make and apply every farm's planting decision for this step"
+    inputs = prepare(eutopia)
+    n = len(eutopia.state)
+    choice, money = numpy.empty(n, dtype=numpy.intp), numpy.empty(n)
+    for block, rows in blocks(n):
+        choice[rows], money[rows] = decide(eutopia, inputs, block, rows, eutopia.counts.local[rows])
+    apply(eutopia, inputs, choice, money)
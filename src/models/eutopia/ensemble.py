@@ -0,0 +1,125 @@
+"""
+Monte Carlo ensembles of Eutopia runs.
+
+Because prices are noisy, one run of a scenario says little about it.
+run_ensemble() runs many replicates of a scenario, each with its own seed, across a pool of
+processes, and streams back the per-step mean and percentile bands of every activity count
+as replicates finish (every `interval` seconds at most). Workers send back only each replicate's activity counts,
+never a whole model or log, so even a 1000-replicate study stays small.
+
+For example:
+```{py}
+import eutopia
+for summary in eutopia.run_ensemble(eutopia.create_demo_model, replicates=1000, steps=20):
+    print(summary['replicates'], summary['mean'][-1])
+```
+"""
+
+import multiprocessing
+import time
+
+import numpy
+
+__all__ = ['run_ensemble', 'Aggregate']
+
+def run_replicate(args):
+    "run one replicate; returns (seed, activity names, (steps, activities) array of counts after each step)"
+    scenario, options, seed, steps = args
+    history = []
+    with scenario(seed=seed, **options) as model:
+        for t in range(steps):
+            next(model)
+            history.append(model.get_activity_count())
+
+    names = sorted(set(name for counts in history for name in counts))
+    counts = numpy.array([[counts.get(name, 0) for name in names] for counts in history], dtype=numpy.int32).reshape(steps, len(names))
+    return seed, names, counts
+
+class Aggregate(object):
+    "accumulates replicates' activity counts, by activity name, and summarizes them"
+    def __init__(self, steps, percentiles=(5, 50, 95), replicates=None):
+        """
+        replicates: how many replicates will be added, if known, so that room for them all is made up front
+        """
+        self.steps = steps
+        self.percentiles = percentiles
+        self.activities = []
+        self._columns = {} #activity name -> its column
+        self._replicates = 0 #how many rows of _counts are filled
+        # Percentiles need every replicate's series, so they are all kept:
+        # replicates x steps x activities x 4 bytes, eg 1000 replicates of 100 steps with 20 activities is 8MB.
+        # Rows are filled in place, one per replicate; the replicate axis (if replicates isn't given) and the activity axis
+        # grow by doubling, so adding stays amortized O(steps x activities) per replicate.
+        self._counts = numpy.zeros((replicates or 16, steps, 4), dtype=numpy.int32)
+
+    def __len__(self):
+        return self._replicates
+
+    @property
+    def counts(self):
+        "the (replicates, steps, activities) counts added so far"
+        return self._counts[:self._replicates,:,:len(self.activities)]
+
+    def _column(self, name):
+        "the column for activity `name`, adding one if it is new (every earlier replicate had 0 of it)"
+        try:
+            return self._columns[name]
+        except KeyError:
+            self._columns[name] = len(self.activities)
+            self.activities.append(name)
+            if len(self.activities) > self._counts.shape[2]:
+                self._grow(self._counts.shape[0], 2*self._counts.shape[2])
+            return self._columns[name]
+
+    def _grow(self, replicates, activities):
+        counts = numpy.zeros((replicates, self.steps, activities), dtype=self._counts.dtype)
+        counts[:self._replicates,:,:self._counts.shape[2]] = self._counts[:self._replicates]
+        self._counts = counts
+
+    def add(self, names, counts):
+        "add one replicate's (steps, len(names)) counts"
+        columns = [self._column(name) for name in names]
+        if self._replicates == len(self._counts):
+            self._grow(2*len(self._counts), self._counts.shape[2])
+        self._counts[self._replicates] = 0
+        self._counts[self._replicates][:, columns] = counts
+        self._replicates += 1
+
+    def summary(self):
+        """
+        the statistics so far, as a dict of
+          replicates: how many replicates have been added
+          activities: the activity names, in column order
+          mean: (steps, activities) array of the mean count of each activity after each step
+          bands: {percentile: (steps, activities) array}
+        """
+        return {'replicates': len(self),
+                'activities': list(self.activities),
+                'mean': self.counts.mean(axis=0),
+                'bands': dict((q, numpy.percentile(self.counts, q, axis=0)) for q in self.percentiles)}
+
+def run_ensemble(scenario, replicates, steps, processes=None, seed=0, percentiles=(5, 50, 95), interval=1.0, **options):
+    """
+    Run `replicates` replicates of `scenario` for `steps` steps each, in a pool of `processes` processes
+    (default: one per core), yielding an Aggregate.summary() as replicates finish: at most once every `interval` seconds,
+    and always once they have all finished.
+    (A summary takes percentiles over every replicate so far, so making one per replicate would be O(replicates^2)
+    and would leave the workers waiting on this process.)
+
+    scenario: a picklable callable (ie a module-level function, like create_demo_model) that takes seed=
+              and **options and returns a configured Eutopia
+    seed: replicate i is run with seed seed+i, so an ensemble can be reproduced (or extended) exactly
+    """
+    aggregate = Aggregate(steps, percentiles, replicates)
+    pool = multiprocessing.Pool(processes)
+    try:
+        jobs = ((scenario, options, seed + i, steps) for i in range(replicates))
+        last = None #when the last summary was made
+        for _, names, counts in pool.imap_unordered(run_replicate, jobs):
+            aggregate.add(names, counts)
+            if len(aggregate) == replicates or last is None or time.time() - last >= interval:
+                yield aggregate.summary()
+                last = time.time()
+        pool.close()
+    finally:
+        pool.terminate()
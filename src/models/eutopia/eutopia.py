@@ -5,6 +5,8 @@
 import os
 from itertools import izip
 
+import numpy
+
 # local libs
 from pygdal import *
 from util import *
@@ -12,6 +14,13 @@ from util import *
 # eutopia files
 import activity
 import intervention
+from spatial import PointIndex, adjacency_matrix
+from state import NO_ACTIVITY, ActivityCodes, FarmState, FamilyState, ActivityCounts
+import batch
+import parallel
+import rng
+import snapshot
+from world import World
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
@@ -31,14 +40,20 @@ __all__ += ['PriceIntervention', 'NewActivityIntervention']
 
 # from activity.py
 from activity import Activity  #ditto #XXX this is probably not super well designed.
+from activity import EXPECTED, ACTUAL
 __all__ += ['Activity']
 
+# from metrics.py
+from metrics import MetricsLog #ditto: users pass these in as the log
+__all__ += ['MetricsLog']
+
 
 #######################
 ## eutopia
 
 MAP_SHAPEFILE = os.path.join(HERE, "Elora_esque.shp.zip") #not in the repo due to copyright; ask a team member
 # TODO: test with passing a folder instead
+WORLD_CACHE = os.path.join(HERE, "worlds") #where World.load() keeps what it derives from the map (see world.py)
 
 AGRICULTURE_CODES = { #hardcoded out of the ARI dataset
    #non-agriculture features are commented out
@@ -63,38 +78,68 @@ AGRICULTURE_CODES = { #hardcoded out of the ARI dataset
    #'ZR': 'REFORESTATION'
 }
 
+NEIGHBOURHOOD_SIZE = 10 #how many of the nearest farms (including itself) a farm considers "local"
+
 class Farm(Feature):
-    def __init__(self, feature):
-        Feature.__init__(self, feature)
+    def __init__(self, world, row):
+        "the farm in row `row` of World `world`"
+        "its feature is only loaded from the map when something asks for its fields or its geometry"
+        self.__dict__['world'] = world #speak to __dict__ directly here because of Feature's dirty __getattr__ magic
+        self.__dict__['_fields'] = world.field_indexes #so that telling fields from other attributes doesn't load our feature
         #self.land_type = land_type #hmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmmm
         self.county = "BestCountyInTheWorldIsMyCountyAndNotYours"
 
+        self.state = None #set by attach() if our state is stored columnarly
+        self.row = row    #our index in Eutopia.farms and in the World (and in the FarmState, if any)
+        self.family = None
         self.last_activity = None
-        self._lat = None
-        self._long = None
+
+    @cached_property
+    def _source(self):
+        "the ogr feature, loaded on first use"
+        return self.world.map.GetFeature(self.id)
+
+    def attach(self, state, row):
+        "move this farm's state into row `row` of FarmState `state`"
+        self.state = state
+        self.row = row
 
     #backwards compat
     @property
-    def id(self): return self.fields.GetFID()
+    def id(self): return int(self.world.id[self.row])
 
+    # the centroid and area are precomputed by World, so asking for them doesn't touch GDAL
     @property
-    @memoize
     def lat(self):
-        return self.geometry.Centroid().GetY() 
+        return float(self.world.y[self.row])
 
     @property
-    @memoize #fun fact: memoizing this function saves 700 times the calls
-             #          --nearly 3 orders of magnitude-- as of this commit.
     def long(self):
-        return self.geometry.Centroid().GetX()
+        return float(self.world.x[self.row])
 
     @property
-    def area(self): return self.geometry.Area()
+    def area(self):
+        if self.state is not None: return self.state.area[self.row]
+        return float(self.world.area[self.row])
 
-class FarmFamily:
+    @property
+    def last_activity(self):
+        if self.state is not None: return self.state.get_activity(self.row)
+        return self._last_activity
+
+    @last_activity.setter
+    def last_activity(self, activity):
+        if self.family is not None: #keep Eutopia's activity counts in step with us
+            self.family.eutopia.activity_changed(self, self.last_activity, activity)
+        if self.state is not None: self.state.set_activity(self.row, activity)
+        else: self._last_activity = activity
+
+class FarmFamily(object):
     def __init__(self, eutopia):
         self.eutopia = eutopia
         self.farms = []
+        self.state = None #set by attach() if our state is stored columnarly
+        self.row = None
         self.bank_balance = 1000000.00
         self.equipment = []
         self.preferences = {'money': 1.0, 
@@ -102,6 +147,21 @@ class FarmFamily:
                             'follow_local':0.2,    # how important is doing what my neighbours are doing
                             }
 
+    def attach(self, state, row):
+        "move this family's state into row `row` of FamilyState `state`"
+        self.state = state
+        self.row = row
+
+    @property
+    def bank_balance(self):
+        if self.state is not None: return self.state.balance[self.row]
+        return self._bank_balance
+
+    @bank_balance.setter
+    def bank_balance(self, balance):
+        if self.state is not None: self.state.balance[self.row] = balance
+        else: self._bank_balance = balance
+
     def add_farm(self, farm):
         self.farms.append(farm)
         farm.family = self
@@ -114,7 +174,7 @@ class FarmFamily:
                 all_activities[k]/=total_activities
 
         if self.preferences.get('follow_local', 0) != 0:
-            local_activities = self.eutopia.get_activity_count(farm.neighbours)
+            local_activities = self.eutopia.counts.as_dict(self.eutopia.latest_local_count[farm.row])
             total_activities = float(sum(local_activities.values()))
             if total_activities > 0:
                 for k,v in local_activities.items():
@@ -124,8 +184,11 @@ class FarmFamily:
         
 
 
+        draw = self.eutopia.draw_key(farm, EXPECTED)
+        coefficients = self.eutopia.activities.coefficients
         best = None
         for activity in activities:
+            a = coefficients.index[activity.name]
             total = 0
             for pref, weight in self.preferences.items():
                 if pref=='follow_society':
@@ -134,7 +197,7 @@ class FarmFamily:
                     if weight != 0:
                         total += local_activities.get(activity.name,0) * weight
                 else:
-                    total += activity.get_product(pref, farm) * weight
+                    total += coefficients.get_product(pref, a, farm.area, draw) * weight
                 # TODO: improve choice algorithm
                 #    - maybe by allowing different sensitivities to risk
                 #      on different income dimensions
@@ -152,42 +215,56 @@ class FarmFamily:
             # changed to self.eutopia to make it work with the sim version that is passed to Family21
             activity = self.make_planting_decision(self.eutopia.activities.activities, farm)
 
-            money = activity.get_product('money', farm)
+            coefficients = self.eutopia.activities.coefficients
+            money = coefficients.get_product('money', coefficients.index[activity.name], farm.area, self.eutopia.draw_key(farm, ACTUAL))
             self.bank_balance += money
 
             farm.last_activity = activity
 
 
 
-class Eutopia:
+class Eutopia(object):
     """
     The Eutopic World
     The main simulation class
     There is an API here for controlling and querying the model state
     """
-    def __init__(self, log = None):
+    def __init__(self, log = None, columnar = False, batch = False, processes = None, seed = None, neighbourhood_size = NEIGHBOURHOOD_SIZE, cache = WORLD_CACHE):
+        """
+        log: a list (or list-like) to append (time, activity counts) to after every step;
+             a MetricsLog stores these as arrays, and is filled straight from the counts
+        columnar: store per-farm state in NumPy arrays (see state.FarmState) instead of on the Farm objects;
+                  this is faster and flatter in memory for big maps
+        batch: make every farm's planting decision at once, as one NumPy computation (see batch.py),
+               instead of looping over FarmFamilies; implies columnar
+        processes: make the batched decisions in this many worker processes (see parallel.py); implies batch
+        seed: the seed for the model's random draws (see rng.py); runs with the same seed give the same results,
+              whether they are serial, batched or parallel. If not given, one is drawn from numpy.random.
+        neighbourhood_size: how many of its nearest farms each farm follows, for the 'follow_local' preference
+        cache: the directory to cache what is derived from the map in (see world.py), or None to always derive it
+        """
         self.log = log
+        self.neighbourhood_size = neighbourhood_size
+        self.seed = seed if seed is not None else numpy.random.randint(2**31)
+        self.batch = batch = batch or bool(processes)
+        columnar = columnar or batch
 
         try:
-            shapefile = Shapefile(MAP_SHAPEFILE)
+            self.world = World.load(MAP_SHAPEFILE, AGRICULTURE_CODES.keys(), neighbourhood_size, cache)
         except IOError:       #py2.7
             #except FileNotFoundError: #py3k
             raise RuntimeError("No shapefile `%s` found; you may need to download it from a team member (privately)" % MAP_SHAPEFILE)
 
-        self.map = shapefile[0] #cheating: assume the only layer we care about is this one
-        assert self.map.GetGeomType() == wkbPolygon, "Farm boundaries layer is not a Polygon; it is a" + str.join(" or ", invertOGRConstants(self.map.GetGeomType()))
-        #assert isinstance(self.map, PolygonLayer), "Farm boundaries layer is not a Polygon; it is a " + str(type(self.map))
-
         #########################
         # modelling begins here
         self.time = 0
         self.activities = activity.Activities()
-        self.interventions = []
+        self.interventions = intervention.Schedule()
 
         #XXX should we write this as literally constructing a new Layer?
         # for now, a List is alright, but it's worth thinking about doing that and about what pygdal requires to support doing that
-        self.farms = [Farm(f) for f in self.map if f.MAP_CODE in AGRICULTURE_CODES.keys()]
-        print("Constructed", len(self.farms), "farms", "out of", len(self.map), "features")
+        self.farms = [Farm(self.world, row) for row in range(len(self.world))]
+        print("Constructed", len(self.farms), "farms", "out of", self.world.features, "features")
 
         self.families = []
         # for now, every Family goes with one single Farm on it
@@ -196,42 +273,91 @@ class Eutopia:
             family.add_farm(farm)
             self.families.append(family)
 
-        for farm in self.farms:
-            farm.neighbours = self.get_local_farms(farm.lat, farm.long, count=10)
+        self.codes = ActivityCodes() #shared by everything that stores activities as ints
+        self.family_state = FamilyState(self.families) if columnar else None
+        self.state = FarmState(self.farms, self.codes) if columnar else None
+
+        # index the farm centroids so neighbourhood queries don't have to sort the whole map
+        self.farm_index = PointIndex(numpy.column_stack([self.world.x, self.world.y]))
+        self.neighbours = self.world.neighbours #neighbours[i] are the indices into self.farms of self.farms[i]'s neighbours
+        for farm, neighbours in izip(self.farms, self.neighbours):
+            farm.neighbours = [self.farms[i] for i in neighbours]
+
+        self.adjacency = adjacency_matrix(self.neighbours) #the same neighbourhoods, as a sparse matrix
+
+        # the global and per-neighbourhood activity histograms, kept up to date by activity_changed()
+        self.counts = ActivityCounts(self.codes, [self.codes.code(farm.last_activity) for farm in self.farms], self.adjacency)
+
+        self.stepper = parallel.Stepper(self, processes) if processes else None
+        self.listeners = [] #see listen()
+
+    @property
+    def map(self):
+        "the map layer; opening it is put off until something needs it (see World.map)"
+        return self.world.map
 
     def dumpsMap(self):
         "convert the map data to a GeoJSON string"
-        "meant to be used in a ModelExplorer endpoint"
+        "meant to be used in a ModelExplorer endpoint; only the first call does any work (see Layer.dumps())"
         return self.map.dumps()
     
+    def iterdumpsMap(self):
+        "the map data as GeoJSON, in pieces, eg for streaming into an HTTP response"
+        return self.map.iterdumps()
+
     def dumpMap(self, fname):
         "write the loaded map data to a file"
         "this function is cruft, but very useful cruft"
         with open(fname,"w") as mapjson:
-            mapjson.write(self.dumpsMap())
+            self.map.dump(mapjson)
 
 
     def __next__(self):
         # apply interventions
-        for intervention in self.interventions:
-            if self.time >= intervention.time:
-                intervention.apply(self, self.time)
+        self.interventions.apply(self, self.time)
 
         # run model
         self.latest_activity_count = self.get_activity_count()
-        for family in self.families:
-            family.step()
+        self.latest_local_count = self.counts.local.copy() #every farm decides on its neighbourhood as it was at the start of the step
+        if self.stepper is not None:
+            self.stepper.step()
+        elif self.batch:
+            batch.step(self)
+        else:
+            for family in self.families:
+                family.step()
         self.time += 1
 
         # log metrics
-        if self.log is not None:
+        if isinstance(self.log, MetricsLog):
+            total = self.counts.total
+            self.log.add(self.time, self.codes.names[:len(total)], total) #(no dict in between)
+        elif self.log is not None:
             self.log.append((self.time, self.get_activity_count())) #XXX assumes a list (or a list-like object)
 
+        for listener in self.listeners:
+            listener(self)
+
     next = __next__ #py2 :(
     step = __next__ #backwards compat
 
     def intervene(self, intervention):
-        self.interventions.append(intervention)
+        self.interventions.add(intervention)
+
+    def close(self):
+        "shut down the worker processes, if any (see parallel.py); stepping the model again starts new ones"
+        if self.stepper is not None:
+            self.stepper.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def listen(self, callback):
+        "have callback(model) called after every step, once it has been logged (eg to push it out to viewers as it happens)"
+        self.listeners.append(callback)
 
     def __iter__(self):
         "convenience method"
@@ -241,8 +367,48 @@ class Eutopia:
                 yield self.get_activity_count() #hardcode model output, for now
         return g()
 
+    def snapshot(self):
+        "pack the model's mutable state (not the map) into a compact string, to restore() later; see snapshot.py"
+        return snapshot.snapshot(self)
+
+    def restore(self, data):
+        "rewind (or fast-forward) to the state in a snapshot() of a model of the same map"
+        snapshot.restore(self, data)
+
+    def draw_key(self, farm, purpose):
+        "the hashed key prefix for farm's random draws this step (see rng.py)"
+        return rng.digest(self.seed, self.time, farm.id, purpose)
+
+    def activity_changed(self, farm, old, new):
+        "called by farm when it switches from activity old to activity new"
+        self.counts.change_one(farm.row, self.codes.code(old), self.codes.code(new))
+
+    NO_FRAME_CODE = 255 #in activity_frame(), for features which aren't farms, or are farms that haven't done anything yet
+
+    def activity_frame(self):
+        """
+        what every feature of the map is doing, as one uint8 per feature, in the map's feature order
+        (which is the order dumpMap() writes them in, and so the order of assets/maps/elora.topo.json):
+        the code of the feature's farm's activity (see self.codes.names), or NO_FRAME_CODE.
+        This comes straight from the activity codes (see state.py), without touching the Farm objects if the state is columnar.
+        """
+        if self.state is not None:
+            activity = self.state.activity
+        else:
+            activity = numpy.fromiter((self.codes.code(farm.last_activity) for farm in self.farms), dtype=numpy.int16, count=len(self.farms))
+        assert len(self.codes) < self.NO_FRAME_CODE, "Too many activities to fit a frame's uint8s"
+        frame = numpy.empty(self.world.features, dtype=numpy.uint8)
+        frame.fill(self.NO_FRAME_CODE)
+        frame[self.world.id] = numpy.where(activity == NO_ACTIVITY, self.NO_FRAME_CODE, activity)
+        return frame
+
     def get_activity_count(self, farms = None):
-        if farms is None: farms = self.farms
+        if farms is None:
+            return self.counts.count()
+
+        if self.state is not None:
+            return self.state.count([farm.row for farm in farms])
+
         activities = {}
         for farm in farms:
             if farm.last_activity is not None:
@@ -254,22 +420,24 @@ class Eutopia:
         return activities
 
     def get_local_farms(self, lat, long, count):
-        dist = [((lat-f.lat)**2 + (long-f.long)**2, f) for f in self.farms]
-        dist.sort()
-        return [d[1] for d in dist]
+        "the `count` farms nearest to (lat, long), nearest first"
+        return [self.farms[i] for i in self.farm_index.nearest(long, lat, count)]
 
     def get_local_activity_count(self, farm, count):
+        if count == self.neighbourhood_size: #we keep this one up to date already
+            return self.counts.local_count(farm.row)
         return self.get_activity_count(self.get_local_farms(farm.lat, farm.long, count))
 
 
-def create_demo_model():
+def create_demo_model(**options):
     """
     Construct Eutopia under a specific scenario.
     
     This subroutine is useful as a benchmark for using Eutopia under different hosts.
+    options are passed on to Eutopia(), e.g. create_demo_model(columnar=True)
     """
-    log = []
-    eutopia = Eutopia(log)
+    log = MetricsLog()
+    eutopia = Eutopia(log, **options)
 
     eutopia.intervene(intervention.PriceIntervention(5, 'duramSeed', 10))
     eutopia.intervene(intervention.PriceIntervention(7, 'duramSeedOrganic', 0.001))
@@ -320,15 +488,13 @@ def main(n=20, dumpMap=False):
         print ("Timestep %d" % (t,))
         next(eutopia)
     
-    activities = [state for time, state in eutopia.log]
-
     # optional: display summary of model outputs
     try:
         import pylab
         print("Plotting activities:")
-        for act in activities[0].keys(): #XXX will break if there are zero activitiesx
+        for act in eutopia.log.names:
             print(act)
-            pylab.plot(range(len(activities)), [a.get(act,0) for a in activities], label=act)
+            pylab.plot(range(len(eutopia.log)), eutopia.log.series(act), label=act)
         pylab.legend(loc='best')
         pylab.show()   #block here until the user closes the plot
     except ImportError:
@@ -0,0 +1,159 @@
+"""
+polygons as flat NumPy arrays.
+
+Asking OGR for each farm's centroid or area is a trip through SWIG per farm (per call, even).
+Polygons holds a whole layer's polygons in four arrays instead:
+
+  coords:           (vertices, 2) x, y of every vertex of every ring, ring after ring
+  ring_offsets:     ring r is coords[ring_offsets[r]:ring_offsets[r+1]]
+  part_offsets:     polygon (part) p is rings part_offsets[p] to part_offsets[p+1]; its first ring is its shell, the rest are holes
+  geometry_offsets: geometry g (ie feature g) is parts geometry_offsets[g] to geometry_offsets[g+1]
+
+(this is the layout GeoArrow and shapely 2 use), so areas, centroids and bounding boxes come out
+of a few vectorized passes over every vertex at once. The arrays are read straight out of
+well-known binary (WKB), one numpy.frombuffer() per ring, without making a Python object per vertex.
+"""
+
+import struct
+
+import numpy
+
+__all__ = ["Polygons"]
+
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+
+def _wkb_type(wkb, offset):
+    "read a WKB geometry header: returns (byte order prefix for struct, base geometry type, coordinate dimension, offset after the header)"
+    endian = "<" if struct.unpack_from("B", wkb, offset)[0] == 1 else ">"
+    type, = struct.unpack_from(endian + "I", wkb, offset + 1)
+    dim = 2
+    if type & 0x80000000: #the old (OGC 1.1/EWKB-style) Z flag
+        type &= ~0x80000000
+        dim = 3
+    if type >= 1000: #ISO: 1000s are Z, 2000s are M, 3000s are ZM
+        dim = {1: 3, 2: 3, 3: 4}[type // 1000]
+        type %= 1000
+    return endian, type, dim, offset + 5
+
+class Polygons(object):
+    "a sequence of (multi)polygons in flat arrays; see the module docstring"
+    def __init__(self, coords, ring_offsets, part_offsets, geometry_offsets):
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.part_offsets = part_offsets
+        self.geometry_offsets = geometry_offsets
+
+    def __len__(self):
+        return len(self.geometry_offsets) - 1
+
+    @classmethod
+    def from_wkb(cls, wkbs):
+        "read a sequence of WKB Polygons and MultiPolygons (None for no geometry); Z and M are dropped"
+        coords = []
+        rings, parts, geometries = [0], [0], [0]
+
+        def polygon(wkb, offset, endian, dim):
+            nrings, = struct.unpack_from(endian + "I", wkb, offset)
+            offset += 4
+            for r in range(nrings):
+                npoints, = struct.unpack_from(endian + "I", wkb, offset)
+                offset += 4
+                points = numpy.frombuffer(wkb, dtype=endian + "f8", count=npoints*dim, offset=offset).reshape(npoints, dim)
+                coords.append(points[:,:2])
+                rings.append(rings[-1] + npoints)
+                offset += 8*npoints*dim
+            parts.append(len(rings) - 1)
+            return offset
+
+        for wkb in wkbs:
+            if wkb is not None:
+                wkb = bytes(wkb)
+                endian, type, dim, offset = _wkb_type(wkb, 0)
+                if type == WKB_POLYGON:
+                    polygon(wkb, offset, endian, dim)
+                elif type == WKB_MULTIPOLYGON:
+                    nparts, = struct.unpack_from(endian + "I", wkb, offset)
+                    offset += 4
+                    for p in range(nparts):
+                        endian, _, dim, offset = _wkb_type(wkb, offset)
+                        offset = polygon(wkb, offset, endian, dim)
+                else:
+                    raise ValueError("Not a Polygon or MultiPolygon: WKB type %d" % (type,))
+            geometries.append(len(parts) - 1)
+
+        coords = numpy.concatenate(coords).astype(numpy.float64) if coords else numpy.zeros((0, 2))
+        return cls(coords, numpy.array(rings, dtype=numpy.int64), numpy.array(parts, dtype=numpy.int64), numpy.array(geometries, dtype=numpy.int64))
+
+    def _sum(self, values, offsets):
+        "sum values over the runs values[offsets[i]:offsets[i+1]], where runs may be empty"
+        n = len(offsets) - 1
+        runs = numpy.repeat(numpy.arange(n), numpy.diff(offsets))
+        if values.ndim == 1:
+            return numpy.bincount(runs, weights=values, minlength=n)
+        totals = numpy.zeros((n, values.shape[1]))
+        for j in range(values.shape[1]):
+            totals[:,j] = numpy.bincount(runs, weights=values[:,j], minlength=n)
+        return totals
+
+    def _rings(self):
+        """
+        per ring: its signed (shoelace) area and the first moments (sum of x and y weighted by area) of that area,
+        counting holes negatively whichever way round they are wound, so that summing over a polygon's rings gives its area and moments
+        """
+        nrings = len(self.ring_offsets) - 1
+        starts = self.ring_offsets[:-1]
+        sizes = numpy.diff(self.ring_offsets)
+        ring = numpy.repeat(numpy.arange(nrings), sizes)
+
+        # work relative to each ring's first vertex, which keeps the cross products small (map units are often large)
+        first = numpy.zeros((nrings, 2))
+        first[sizes > 0] = self.coords[starts[sizes > 0]]
+        local = self.coords - first[ring]
+        x0, y0 = local[:-1,0], local[:-1,1]
+        x1, y1 = local[1:,0], local[1:,1]
+        cross = x0*y1 - x1*y0
+        edge = ring[:-1] == ring[1:] #pairs of consecutive vertices that are in the same ring
+        cross = cross*edge
+
+        # the pairs starting in ring r are pairs starts[r] up to starts[r+1] (the last of which, crossing into ring r+1, is masked off)
+        pairs = numpy.append(starts, len(cross)).clip(0, len(cross))
+        area = self._sum(cross, pairs) / 2
+        moments = self._sum(numpy.column_stack([(x0 + x1)*cross, (y0 + y1)*cross]), pairs) / 6
+
+        # shells count positively and holes negatively, whichever way they're wound
+        shell = numpy.zeros(nrings, dtype=bool)
+        shell[self.part_offsets[:-1][numpy.diff(self.part_offsets) > 0]] = True
+        sign = numpy.where(shell, 1.0, -1.0) * numpy.where(area < 0, -1.0, 1.0)
+        area = area*sign
+        moments = moments*sign[:,None] + area[:,None]*first #back from relative to each ring's first vertex to absolute
+        return area, moments
+
+    def _per_geometry(self, values):
+        "sum per-ring values up to per-geometry values"
+        per_part = self._sum(values, self.part_offsets)
+        return self._sum(per_part, self.geometry_offsets)
+
+    def areas(self):
+        "the area of each geometry (polygon areas less their holes'), as OGR's Area() gives it"
+        area, _ = self._rings()
+        return self._per_geometry(area)
+
+    def centroids(self):
+        "the (area-weighted) centroid of each geometry, as OGR's Centroid() gives it, as an (n, 2) array; NaN for empty or zero-area geometries"
+        area, moments = self._rings()
+        total = self._per_geometry(area)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return self._per_geometry(moments) / total[:,None]
+
+    def bounds(self):
+        "the bounding box of each geometry, as an (n, 4) array of (minx, miny, maxx, maxy); NaN for empty geometries"
+        vertex_offsets = self.ring_offsets[self.part_offsets[self.geometry_offsets]]
+        result = numpy.empty((len(self), 4))
+        result.fill(numpy.nan)
+        nonempty = numpy.diff(vertex_offsets) > 0
+        if nonempty.any():
+            starts = vertex_offsets[:-1][nonempty]
+            result[nonempty,:2] = numpy.minimum.reduceat(self.coords, starts)
+            result[nonempty,2:] = numpy.maximum.reduceat(self.coords, starts)
+        return result
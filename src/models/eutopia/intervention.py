@@ -1,7 +1,83 @@
+import bisect
+import heapq
+
 import activity
 
 __all__ = ['PriceIntervention', 'NewActivityIntervention']
 
+# An intervention has a .time, the first step it applies at, and an .apply(eutopia, time),
+# which returns true if it needs applying again the next step (eg while it is being phased in)
+# and false once it is done, so that the Schedule can drop it.
+# It may also have a .target, naming what it sets (eg ('money', product) for a price), for interventions
+# which overwrite each other; see Schedule.
+
+def _target(intervention):
+    return getattr(intervention, 'target', None)
+
+class Schedule(object):
+    """
+    the interventions of a model, in a queue by when they are next due,
+    so that each step only touches the ones that are due or still being phased in.
+    It is list-like enough for the callers that used to keep interventions in a list (append(), iteration, del s[:]).
+
+    Interventions used to be re-applied every step, in the order they were added, so of several with the same
+    target the one added last won, whenever the others started. To keep that, an intervention is also
+    retired once one added after it with the same target has been applied (which overwrites it every step from then on),
+    and is kept on, even when it is done, while one with its target that was added before it is still to start
+    (so that it overwrites that one again when it does).
+    """
+    def __init__(self):
+        self._pending = [] #heap of (time, order, intervention) not yet applied
+        self._active = []  #(order, intervention) of those to be applied again
+        self._order = 0    #how many have been added; ties in time go in the order they were added
+        self._waiting = {} #target -> sorted orders of the pending interventions with that target
+
+    def add(self, intervention):
+        heapq.heappush(self._pending, (intervention.time, self._order, intervention))
+        if _target(intervention) is not None:
+            bisect.insort(self._waiting.setdefault(_target(intervention), []), self._order)
+        self._order += 1
+
+    append = add
+
+    def apply(self, eutopia, time):
+        "apply everything due by `time`, in the order they were added, and retire what's done"
+        due = self._active
+        while self._pending and self._pending[0][0] <= time:
+            _, order, intervention = heapq.heappop(self._pending)
+            if _target(intervention) is not None:
+                self._waiting[_target(intervention)].remove(order)
+            due.append((order, intervention))
+        due.sort()
+
+        applied = [(order, intervention, intervention.apply(eutopia, time)) for order, intervention in due]
+        latest = dict((_target(intervention), order) for order, intervention, _ in applied) #target -> the last added of this step's
+
+        def keep(order, intervention, again):
+            target = _target(intervention)
+            if target is None:
+                return again
+            if latest[target] != order: #overwritten by a later one
+                return False
+            waiting = self._waiting.get(target)
+            return again or bool(waiting and waiting[0] < order)
+        self._active = [(order, intervention) for order, intervention, again in applied if keep(order, intervention, again)]
+
+    def __iter__(self):
+        "the interventions which haven't been retired, in the order they were added"
+        return iter([intervention for order, intervention in sorted(self._active + [(order, i) for _, order, i in self._pending])])
+
+    def __len__(self):
+        return len(self._pending) + len(self._active)
+
+    def __delitem__(self, index):
+        "eg del schedule[:] to drop every intervention"
+        interventions = list(self)
+        del interventions[index]
+        self._pending, self._active, self._waiting = [], [], {}
+        for intervention in interventions:
+            self.add(intervention)
+
 class PriceIntervention:
     def __init__(self, time, product, scale, phase_in_time=0):
         self.time = time
@@ -9,22 +85,27 @@ class PriceIntervention:
         self.scale = scale
         self.phase_in_time = phase_in_time
         self.original_value = None
+
+    @property
+    def target(self):
+        "what we set; see Schedule"
+        return ('money', self.product)
         
     def apply(self, eutopia, time):
         assert time>=self.time
         
-        money = eutopia.activities.aggregates['money']
-        
         if self.original_value is None:
-            self.original_value = money[self.product]
+            self.original_value = eutopia.activities.aggregates['money'][self.product]
         
         scale = self.scale
+        ratio = 1
         if self.phase_in_time>0:
-            ratio = float(time-self.time)/phase_in_time
+            ratio = float(time-self.time)/self.phase_in_time
             if ratio>1: ratio = 1
             scale = scale*ratio    
         
-        money[self.product] = self.original_value*scale
+        eutopia.activities.set_measure('money', self.product, self.original_value*scale)
+        return ratio < 1 #still phasing in
             
             
 class NewActivityIntervention:
@@ -36,6 +117,7 @@ class NewActivityIntervention:
     def apply(self, eutopia, time):
         if time == self.time:
             a = activity.Activity(self.name, aggregate_measures=eutopia.activities.aggregates, **self.activity)
-            eutopia.activities.activities.append(a)
+            eutopia.activities.add(a)
+        return False #one-shot
         
         
@@ -0,0 +1,207 @@
+"""
+an array-backed store for Eutopia's log.
+
+Eutopia.log used to be a list of (time, {activity: count}), one dict per step.
+MetricsLog keeps the same data as columns instead: an int64 array of the times and an
+(steps, metrics) int64 array of the counts, one column per metric (ie activity), grown by doubling
+so appending is amortized O(1). A time range or a single metric's series is then a slice, not a walk over dicts:
+```{py}
+log = MetricsLog()
+model = Eutopia(log)
+...
+times, counts = log.between(10, 20)         #counts is (steps, len(log.names))
+wheat = log.series('durumWheatGreen')
+```
+It still acts like the list it replaces (len(), log[i], log[-1], iteration, slicing, append((time, counts)), del log[n:]),
+giving back (time, {metric: count}) with the zero counts left out, as Eutopia used to log them.
+
+Given a limit, it keeps only the newest rows in memory, and moves older ones into segments
+(pairs of .npy files) in the `spill` directory, which are memory-mapped back in when read.
+"""
+
+import os
+import bisect
+
+import numpy
+
+__all__ = ["MetricsLog"]
+
+class MetricsLog(object):
+    def __init__(self, limit=None, spill=None):
+        """
+        limit: the most rows to keep in memory; older rows are spilled to disk, `limit` at a time
+        spill: the directory to spill to (it is made if need be); required with limit
+        """
+        assert limit is None or spill is not None, "MetricsLog needs a spill directory to spill to"
+        self.limit = limit
+        self.spill = spill
+        self.names = []   #the metric of each column
+        self._columns = {} #name -> column
+        self._segments = [] #(first row, rows, columns, times path, values path) of each spilled segment, oldest first
+        self._mapped = {}   #segment number -> (times, values), memory-mapped
+        self._start = 0     #the row number of the first row in memory
+        self._times = numpy.zeros(16, dtype=numpy.int64)
+        self._values = numpy.zeros((16, 0), dtype=numpy.int64)
+        self._rows = 0      #rows in memory
+
+    def __len__(self):
+        return self._start + self._rows
+
+    def _column(self, name):
+        "the column for metric `name`, adding one if it is new"
+        try:
+            return self._columns[name]
+        except KeyError:
+            self._columns[name] = len(self.names)
+            self.names.append(name)
+            if len(self.names) > self._values.shape[1]:
+                values = numpy.zeros((len(self._times), max(2*self._values.shape[1], 4)), dtype=numpy.int64)
+                values[:self._rows,:self._values.shape[1]] = self._values[:self._rows]
+                self._values = values
+            return self._columns[name]
+
+    def add(self, time, names, values):
+        "log the metrics `names` as having `values` (the rest as 0) at `time`"
+        columns = [self._column(name) for name in names]
+        if self._rows == len(self._times):
+            self._times = numpy.concatenate([self._times, numpy.zeros_like(self._times)])
+            self._values = numpy.concatenate([self._values, numpy.zeros_like(self._values)])
+        self._times[self._rows] = time
+        self._values[self._rows] = 0
+        self._values[self._rows, columns] = values
+        self._rows += 1
+        if self.limit is not None and self._rows >= 2*self.limit:
+            self._spill(self.limit)
+
+    def append(self, entry):
+        "log (time, {metric: count}), like list.append()"
+        time, counts = entry
+        self.add(time, list(counts.keys()), list(counts.values()))
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def _spill(self, rows):
+        "move the oldest `rows` rows in memory out to a new segment on disk"
+        if not os.path.isdir(self.spill):
+            os.makedirs(self.spill)
+        n = len(self._segments)
+        paths = [os.path.join(self.spill, "%d.%s.npy" % (n, part)) for part in ("times", "values")]
+        numpy.save(paths[0], self._times[:rows])
+        numpy.save(paths[1], self._values[:rows,:len(self.names)])
+        self._segments.append((self._start, rows, len(self.names), paths[0], paths[1]))
+
+        self._times[:self._rows-rows] = self._times[rows:self._rows].copy()
+        self._values[:self._rows-rows] = self._values[rows:self._rows].copy()
+        self._start += rows
+        self._rows -= rows
+
+    def _segment(self, s):
+        "spilled segment s, as (times, values)"
+        if s not in self._mapped:
+            _, _, _, times, values = self._segments[s]
+            self._mapped[s] = numpy.load(times, mmap_mode='r'), numpy.load(values, mmap_mode='r')
+        return self._mapped[s]
+
+    def rows(self, start, stop):
+        "rows [start, stop) (0 <= start <= stop <= len(self)), as (times, values); values has a column for every one of self.names"
+        times, values = [], []
+        if start < self._start: #some are on disk
+            s = max(bisect.bisect_right([segment[0] for segment in self._segments], start) - 1, 0)
+            for s in range(s, len(self._segments)):
+                first, n, columns = self._segments[s][:3]
+                if first >= stop: break
+                a, b = max(start - first, 0), min(stop - first, n)
+                t, v = self._segment(s)
+                padded = numpy.zeros((b - a, len(self.names)), dtype=numpy.int64) #(metrics that first showed up after the spill are 0 in it)
+                padded[:,:columns] = v[a:b]
+                times.append(numpy.asarray(t[a:b]))
+                values.append(padded)
+        a, b = max(start - self._start, 0), max(stop - self._start, 0)
+        times.append(self._times[a:b])
+        values.append(self._values[a:b,:len(self.names)])
+        if len(times) == 1:
+            return times[0], values[0]
+        return numpy.concatenate(times), numpy.concatenate(values)
+
+    def between(self, start, stop):
+        "the rows logged at times in [start, stop), as (times, values); see rows()"
+        "assumes (like Eutopia's) that times only go up"
+        if self._start: #cheap enough, next to reading the segments themselves
+            times = self.rows(0, len(self))[0]
+        else:
+            times = self._times[:self._rows]
+        return self.rows(numpy.searchsorted(times, start), numpy.searchsorted(times, stop))
+
+    def series(self, name, start=0, stop=None):
+        "the values of metric `name` over rows [start, stop) (0 before it first appeared)"
+        times, values = self.rows(start, len(self) if stop is None else stop)
+        if name not in self._columns:
+            return numpy.zeros(len(times), dtype=numpy.int64)
+        return values[:,self._columns[name]]
+
+    def _entry(self, time, values):
+        return (int(time), dict((name, int(v)) for name, v in zip(self.names, values) if v))
+
+    def __getitem__(self, i):
+        "(time, {metric: count}), like the list this replaces, or a list of them, for a slice"
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1 or stop < start:
+                return [self[j] for j in range(start, stop, step)]
+            times, values = self.rows(start, stop)
+            return [self._entry(t, v) for t, v in zip(times, values)]
+        if i < 0:
+            i += len(self)
+        if not (0 <= i < len(self)):
+            raise IndexError("log index out of range")
+        times, values = self.rows(i, i+1)
+        return self._entry(times[0], values[0])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __delitem__(self, i):
+        "only del log[n:] (eg del log[:], to start over) is supported"
+        if not (isinstance(i, slice) and i.stop is None and i.step is None):
+            raise TypeError("MetricsLog only supports deleting from a row on (del log[n:])")
+        start = i.indices(len(self))[0]
+        if start == 0:
+            self.clear()
+        else:
+            self.truncate(start)
+
+    def truncate(self, n):
+        "forget every row from row n on (eg to go back to a snapshot; see snapshot.restore())"
+        if n >= len(self):
+            return
+        if n >= self._start:
+            self._rows = n - self._start
+            return
+        # n is on disk: bring the rows before it in its segment back into memory, and drop that segment and every later one
+        s = bisect.bisect_right([segment[0] for segment in self._segments], n) - 1
+        first = self._segments[s][0]
+        times, values = self.rows(first, n)
+        if len(times) > len(self._times):
+            self._times = numpy.zeros(len(times), dtype=numpy.int64)
+            self._values = numpy.zeros((len(times), self._values.shape[1]), dtype=numpy.int64)
+        self._times[:len(times)] = times
+        self._values[:len(times),:len(self.names)] = values
+        for segment in self._segments[s:]:
+            for path in segment[3:]:
+                if os.path.exists(path): os.remove(path)
+        del self._segments[s:]
+        self._mapped = dict((k, v) for k, v in self._mapped.items() if k < s)
+        self._start, self._rows = first, len(times)
+
+    def clear(self):
+        "forget everything, including any spilled segments"
+        for segment in self._segments:
+            for path in segment[3:]:
+                if os.path.exists(path): os.remove(path)
+        self._segments, self._mapped = [], {}
+        self.names, self._columns = [], {}
+        self._start, self._rows = 0, 0
+        self._values = numpy.zeros((len(self._times), 0), dtype=numpy.int64)
@@ -0,0 +1,94 @@
+"""
+multi-core stepping for Eutopia.
+
+Within a step every batched planting decision (see batch.py) depends only on the state at the
+start of the step, so the farms can be split into partitions and decided in parallel.
+Stepper does that with a pool of worker processes forked from the process that owns Eutopia:
+
+ * the farms' activity codes, and the per-farm outputs (choice and money), live in shared memory;
+ * the static per-farm arrays (areas, preference weights, the neighbour matrix) are inherited by the fork;
+ * each step, only the small batch.Inputs are sent to the workers;
+ * each worker counts its own farms' neighbourhoods from the shared activity codes,
+   decides its blocks, and writes the results back into shared memory,
+   which the parent then merges with batch.apply() as the serial batch engine does.
+
+Since every farm's draws are keyed by the farm (see rng.py), a parallel run is identical to a serial
+run with the same seed, however many processes it uses.
+
+This uses fork(), so it works on Linux and OS X, but not on Windows.
+"""
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
+
+import batch
+
+__all__ = ["shared_array", "Stepper"]
+
+def shared_array(n, dtype):
+    "a length-n NumPy array in memory that forked processes share with us"
+    dtype = numpy.dtype(dtype)
+    return numpy.frombuffer(RawArray('b', n*dtype.itemsize), dtype=dtype)
+
+_eutopia = None #the worker processes' (forked) view of the model and the shared buffers
+_choice = None
+_money = None
+
+def _init_worker(eutopia, choice, money):
+    global _eutopia, _choice, _money
+    _eutopia, _choice, _money = eutopia, choice, money
+
+def _decide(args):
+    "worker side: decide the farms in [start, stop), writing into the shared buffers"
+    inputs, start, stop = args
+    activity = _eutopia.state.activity #shared, so this is the parent's current state
+
+    # count our farms' neighbourhoods
+    neighbourhoods = _eutopia.adjacency[start:stop]
+    local = numpy.zeros((stop - start, inputs.ncodes))
+    for code in range(inputs.ncodes):
+        local[:,code] = neighbourhoods.dot((activity == code).astype(numpy.float64))
+
+    for block, rows in batch.blocks(len(activity), start, stop):
+        _choice[rows], _money[rows] = batch.decide(_eutopia, inputs, block, rows, local[rows.start-start:rows.stop-start])
+
+class Stepper(object):
+    "steps a (batched) Eutopia with `processes` worker processes"
+    def __init__(self, eutopia, processes):
+        self.eutopia = eutopia
+        self.processes = processes
+        n = len(eutopia.state)
+
+        # move the farms' activity into shared memory so the workers always see the current state
+        activity = shared_array(n, eutopia.state.activity.dtype)
+        activity[:] = eutopia.state.activity
+        eutopia.state.activity = activity
+
+        self.choice = shared_array(n, numpy.intp)
+        self.money = shared_array(n, numpy.float64)
+
+        # split the farms into one contiguous, block-aligned partition per process
+        # (decisions only read the state at the start of the step, so partitions don't need to be spatially compact)
+        nblocks = (n + batch.BLOCK_SIZE - 1) // batch.BLOCK_SIZE
+        bounds = [min(n, (nblocks * p // processes) * batch.BLOCK_SIZE) for p in range(processes+1)]
+        self.partitions = [(start, stop) for start, stop in zip(bounds, bounds[1:]) if start < stop]
+
+        self._pool = None
+
+    def step(self):
+        "make and apply every farm's planting decision for this step"
+        if self._pool is None:
+            # fork lazily, so that the workers inherit the finished model
+            self._pool = multiprocessing.Pool(self.processes, _init_worker, (self.eutopia, self.choice, self.money))
+        inputs = batch.prepare(self.eutopia)
+        self._pool.map(_decide, [(inputs, start, stop) for start, stop in self.partitions])
+        batch.apply(self.eutopia, inputs, self.choice, self.money)
+
+    def close(self):
+        "shut down the worker processes; stepping again starts new ones"
+        "(the pool holds on to the model, so this has to be called explicitly, eg through Eutopia.close())"
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
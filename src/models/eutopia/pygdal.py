@@ -22,12 +22,14 @@ words to the wise:
   The python GC causing terrible inconsistencies in the C++ layer is a nether I want to bottle and keep far away.
 """
 
-import os, zipfile, tempfile, shutil
+import os, zipfile, errno, json, shutil, tempfile, numbers
 
-import json #GDAL has ExportToJSON so so should PyGDAL
+import numpy
 
+from geometry import Polygons
 
-__all__ = ["Shapefile", "Layer", "Feature"]
+
+__all__ = ["Shapefile", "Layer", "Feature", "ColumnarLayer"]
 
 #import gdal
 import ogr
@@ -44,33 +46,50 @@ def invertOGRConstant(value):
     "i'm sorry; this is really just a quick hack for debugging and should be replaced by wrapping the OGR constants in enum objects"
     return [n for n in ogr.CONSTANTS if ogr.CONSTANTS[n] == value]
 
-class Shapefile(object):
-    "XXX this needs unit tests, badly"
-    "wraps an ogr.DataSource to be less ridiculous"
-    "Idea: give all members a pointer to this class, so that (but maybe this would be a terrible memory-hogging mistake..)"
-    "then, so long as at least one feature from this shapefile is pointed to from the main program, the whole datastructure will stick around"
-    def __init__(self, fname):
+_sources = {} #(path, pid) -> ogr.DataSource
+
+def open_source(fname):
+    "open fname with OGR, or give back the DataSource this process already opened it as"
+    "zipfiles are read in place, through GDAL's /vsizip/ virtual filesystem, instead of being extracted"
+    fname = os.path.abspath(fname)
+    key = (fname, os.getpid()) #a forked child opens its own: OGR handles don't survive being shared across processes
+    if key not in _sources:
+        path = fname
         if zipfile.is_zipfile(fname):
-            #the logic here should be:
-            # check if zipfile, if so unzip and continue as if that didn't happen
             #TODO: support writebacks to a zipped Shapefile (VERY COMPLICATED)
+            path = "/vsizip/" + fname
 
-            self._unzipped = tempfile.mkdtemp()
-            with zipfile.ZipFile(open(fname, "rb")) as zhp: #open the zipped shapefile
-                zhp.extractall(path=self._unzipped)
-
-            fname = self._unzipped
-
-        self._source = ogr.Open(fname)
-        if self._source is None: #an error occurred, but (by experiment) OGR won't tell us what it is
+        try:
+            source = ogr.Open(path)
+        except RuntimeError: #ogr gives this for all errors when UseExceptions() is on
+            source = None
+        if source is None: #an error occurred, but (by experiment) OGR won't tell us what it is
             #this should be FileNotFoundError, but we're stuck in Python2
             raise IOError("Unable to read shapefile '%s'" % (fname,))
+        _sources[key] = source
+    return _sources[key]
+
+def field_indexes(defn):
+    "the {name: index} of the fields of an ogr.FeatureDefn, so fields can be got by index instead of by name"
+    return dict((defn.GetFieldDefn(i).GetName(), i) for i in range(defn.GetFieldCount()))
 
-    def __del__(self):
-        "on finalization, clean up after ourselves"
-        if hasattr(self, '_unzipped'):
-            del self._source  #we need to close the source before rm -r will work
-            shutil.rmtree(self._unzipped)
+def _column(values, type):
+    "turn a list of field values into a NumPy array of the type that goes with OGR field type `type`"
+    "null integers make the column float, so that they can be NaN"
+    if type in (ogr.OFTInteger, getattr(ogr, "OFTInteger64", ogr.OFTInteger)) and None not in values:
+        return numpy.array(values, dtype=numpy.int64)
+    if type in (ogr.OFTInteger, getattr(ogr, "OFTInteger64", ogr.OFTInteger), ogr.OFTReal):
+        return numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+    return numpy.array(["" if v is None else v for v in values], dtype=bytes)
+
+class Shapefile(object):
+    "XXX this needs unit tests, badly"
+    "wraps an ogr.DataSource to be less ridiculous"
+    "Idea: give all members a pointer to this class, so that (but maybe this would be a terrible memory-hogging mistake..)"
+    "then, so long as at least one feature from this shapefile is pointed to from the main program, the whole datastructure will stick around"
+    "Shapefiles of the same file share one DataSource (per process); see open_source()"
+    def __init__(self, fname):
+        self._source = open_source(fname)
 
     @property
     def name(self):
@@ -98,61 +117,237 @@ class Shapefile(object):
         return l
         
 
+def sql_literal(value):
+    "quote value for an OGR SQL expression"
+    if isinstance(value, basestring):
+        return "'%s'" % value.replace("'", "''")
+    if isinstance(value, numbers.Integral): #(not repr(), which gives py2 longs an L)
+        return str(int(value))
+    return repr(value) #(floats: repr() doesn't round, as str() does on py2)
+
+def sql_and(clauses):
+    "join OGR SQL expressions with AND, or give None if there are none"
+    clauses = [c for c in clauses if c]
+    if len(clauses) <= 1:
+        return clauses[0] if clauses else None
+    return " AND ".join("(%s)" % c for c in clauses)
+
+def intersect_bboxes(a, b):
+    "the intersection of two (minx, miny, maxx, maxy) boxes, either of which may be None (for no box)"
+    if a is None: return b
+    if b is None: return a
+    return (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+
 class Layer(object):
     "TODO:"
     "support queries (ie SQL) on the layer"
     "...it is probably worth writing this (and not just relying on list comprehensions) precisely because DBs are good at queries"
-    def __init__(self, ogr_layer):
+    "  (a start: where() filters with OGR's attribute and spatial filters)"
+    def __init__(self, ogr_layer, where=None, bbox=None):
+        "where and bbox restrict this Layer to some of ogr_layer's features; see where()"
         if isinstance(ogr_layer, Layer): #support copy-construction
+            where = sql_and([ogr_layer._where, where])
+            bbox = intersect_bboxes(ogr_layer._bbox, bbox)
             ogr_layer = ogr_layer._source
-        
+
         #otherwise, wrap a raw GDAL object:
         assert isinstance(ogr_layer, ogr.Layer)
         self._source = ogr_layer
+        self._where = where
+        self._bbox = bbox
+        self.version = 0      #bumped by every edit made through us; see dumps()
+        self._encoded = None  #(version, GeoJSON)
+        self._fields = None   #(version, field_indexes())
+
+    def where(self, sql=None, bbox=None, **fields):
+        """
+        a view of the features of this layer which match all of:
+          sql:      an OGR SQL WHERE clause, eg "AREA > 1000"
+          bbox:     (minx, miny, maxx, maxy); features have to intersect it
+          **fields: field=value, or field=[values] for any of several, eg where(MAP_CODE=AGRICULTURE_CODES.keys())
+        The filtering is done by OGR (and so by the driver's indexes, where it has them) as the view is read,
+        so features that don't match are never even turned into python objects.
+        """
+        clauses = [sql] if sql else []
+        for field, value in sorted(fields.items()):
+            if isinstance(value, (list, tuple, set, frozenset)):
+                if not value: #nothing is IN (), which isn't SQL anyway
+                    clauses.append("1=0")
+                else:
+                    clauses.append("%s IN (%s)" % (field, ", ".join(sql_literal(v) for v in value)))
+            else:
+                clauses.append("%s = %s" % (field, sql_literal(value)))
+        L = Layer(self, sql_and(clauses), bbox)
+        L.parent = self
+        return L
+
+    def _filter(self):
+        "install our filters on the ogr layer (which every Layer of it shares, so this has to be done each time it is read)"
+        self._source.SetAttributeFilter(self._where)
+        if self._bbox is None:
+            self._source.SetSpatialFilter(None)
+        else:
+            self._source.SetSpatialFilterRect(*self._bbox)
+
+    # OGR Layer methods which change what's in it
+    EDITS = set(["SetFeature", "CreateFeature", "DeleteFeature", "CreateField", "DeleteField", "AlterFieldDefn", "ReorderFields"])
 
     def __getattr__(self, a):
         "until this library is fleshed out, just proxy most Layer calls through"
         try:
             return self.__dict__[a]
         except KeyError:
+            if a in Layer.EDITS:
+                self.version += 1
             return getattr(self._source, a)
 
     @property
     def name(self):
         return self._source.GetName()
 
+    @property
+    def field_indexes(self):
+        "{name: index} of our fields; every Feature we give out shares this"
+        if self._fields is None or self._fields[0] != self.version:
+            self._fields = (self.version, field_indexes(self._source.GetLayerDefn()))
+        return self._fields[1]
+
     def __len__(self):
+        self._filter()
         return self._source.GetFeatureCount()
 
     def __getitem__(self, i):
-        if not (0 <= i < len(self)):
-            raise IndexError("%s only has layers %d through %d" % (self.name(),0, i))
-        F = Feature(self._source.GetFeature(i))
+        "random access, by feature id (which where() doesn't apply to); to go through every feature, iterating is much faster"
+        try:
+            f = self._source.GetFeature(i)
+        except RuntimeError: #ogr gives this for all errors when UseExceptions() is on
+            f = None
+        if f is None:
+            raise IndexError("%s has no feature %d" % (self.name, i))
+        F = Feature(f, self.field_indexes)
         F.parent = self #parent pointers are set here instead of as a constructor arg because we don't necessarily know that Features are crafted out of a parent; but here in __getitem__ we do know that
         return F
 
-    def __iter__(self): #XXX this particular piece of code seems so simple that it must be factorable
-        for i in range(len(self)):
-            yield self[i]
+    def _features(self):
+        "stream the raw ogr features, in order, with OGR's sequential reader"
+        "the reader (like the filters) belongs to the ogr layer, so don't interleave iterating two Layers of the same one"
+        self._filter()
+        self._source.ResetReading()
+        while True:
+            f = self._source.GetNextFeature()
+            if f is None:
+                return
+            yield f
 
-    def dumps(self):
+    def __iter__(self):
+        fields = self.field_indexes
+        for f in self._features():
+            F = Feature(f, fields)
+            F.parent = self
+            yield F
+
+    def to_columns(self, fields=None, fid=False, geometry=False):
+        """
+        read whole columns at once: returns {field: NumPy array of that field's value for every feature, in order}
+        for each name in `fields` (default: every field), and, if fid is true, the feature ids, as "FID",
+        and, if geometry is true, the (multi)polygons, as a geometry.Polygons, as "geometry".
+        Integer fields give int64 arrays (or float64, with NaNs, if any are null), real fields float64,
+        and everything else byte strings.
+        This is one pass over the layer (or this view of it) that never builds a Feature.
+        """
+        indexes = self.field_indexes
+        if fields is None:
+            fields = sorted(indexes, key=indexes.get)
+        columns = [(indexes[name], []) for name in fields]
+        fids = []
+        wkbs = []
+        for f in self._features():
+            if fid: fids.append(f.GetFID())
+            if geometry:
+                g = f.GetGeometryRef()
+                wkbs.append(g.ExportToWkb() if g is not None else None)
+            for i, values in columns:
+                values.append(f.GetField(i))
+
+        defn = self._source.GetLayerDefn()
+        result = dict((name, _column(values, defn.GetFieldDefn(i).GetType())) for name, (i, values) in zip(fields, columns))
+        if fid:
+            result["FID"] = numpy.array(fids, dtype=numpy.int64)
+        if geometry:
+            result["geometry"] = Polygons.from_wkb(wkbs)
+        return result
+
+    def to_polygons(self):
+        "every feature's geometry, as flat arrays (see geometry.Polygons)"
+        return self.to_columns([], geometry=True)["geometry"]
+
+    def to_columnar(self, path, fields=None):
+        "convert this layer (or view of it) to a ColumnarLayer at `path`: its feature ids (as the column FID), `fields` (default: all) and polygons"
+        "anything already at `path` is replaced"
+        columns = self.to_columns(fields, fid=True, geometry=True)
+        polygons = columns.pop("geometry")
+        return ColumnarLayer.write(path, columns, polygons, {"name": self.name})
+
+    def iterdumps(self, chunk=1<<16):
         "GDAL doesn't have a layer.ExportToJson()"
         "So we need to write it"
-        "this line derived from the spec at http://geojson.org/geojson-spec.html#feature-collection-objects"
-        return json.dumps({"type": "FeatureCollection", "features": [json.loads(f.ExportToJson()) for f in self]})
+        "this generates the GeoJSON FeatureCollection in pieces of about `chunk` bytes,"
+        "splicing together each feature's own ExportToJson() instead of building the whole collection in memory"
+        "(the format is from the spec at http://geojson.org/geojson-spec.html#feature-collection-objects)"
+        if self._encoded is not None and self._encoded[0] == self.version:
+            encoded = self._encoded[1]
+            for i in range(0, len(encoded), chunk):
+                yield encoded[i:i+chunk]
+            return
+
+        pieces, size = ['{"type": "FeatureCollection", "features": ['], 0
+        for i, f in enumerate(self):
+            if i: pieces.append(", ")
+            pieces.append(f.ExportToJson())
+            size += len(pieces[-1])
+            if size >= chunk:
+                yield "".join(pieces)
+                pieces, size = [], 0
+        pieces.append("]}")
+        yield "".join(pieces)
+
+    def dump(self, fp):
+        "write the layer, as GeoJSON, to the file(-like object) fp, a piece at a time"
+        for piece in self.iterdumps():
+            fp.write(piece)
+
+    def dumps(self):
+        "the layer as a GeoJSON string"
+        "this is cached until the layer is next edited through us (edits made some other way, eg through another Layer of the same file, aren't noticed)"
+        if self._encoded is None or self._encoded[0] != self.version:
+            self._encoded = (self.version, "".join(self.iterdumps()))
+        return self._encoded[1]
 
 
 class Feature(object):
     "a simple wrapper that makes OGR Features objects pythonic"
     "every row in the table is exposed as a property"
     "this class is the start of scratch/pygdal"
-    def __init__(self, ogr_feature):
+    def __init__(self, ogr_feature, fields=None):
+        "fields: the field_indexes() of the feature's FeatureDefn, if the caller has them (eg from its Layer), to save working them out"
         if isinstance(ogr_feature, Feature): #support copy-construction
+            fields = ogr_feature._field_indexes
             ogr_feature = ogr_feature._source
-        
+
         #otherwise, wrap a raw GDAL object:
         assert isinstance(ogr_feature, ogr.Feature), "%s is not a ogr.Feature" % (ogr_feature,)
         self.__dict__['_source'] = ogr_feature #speak to __dict__ directly here because of dirty __getattr__ magic
+        if fields is not None:
+            self.__dict__['_fields'] = fields
+
+    @property
+    def _field_indexes(self):
+        "{name: index} of our fields"
+        try:
+            return self.__dict__['_fields']
+        except KeyError:
+            self.__dict__['_fields'] = field_indexes(self._source.GetDefnRef())
+            return self.__dict__['_fields']
     
     @property
     def geometry(self):
@@ -171,20 +366,122 @@ class Feature(object):
             return self.__dict__[name]
         except KeyError:
             try:
-                return self._source.GetField(name)
-            except:
+                i = self._field_indexes[name]
+            except KeyError:
                 raise KeyError(name)
                 #return getattr(self, name) #this causes an infinite loop
+            return self._source.GetField(i) #by index: looking fields up by name is slow in OGR
 
             #TODO: use
             #return object.__getattribute__(self, name) #very python2...  <http://stackoverflow.com/questions/3278077/difference-between-getattr-vs-getattribute-in-python>
 
     def __setattr__(self, name, value):
-        # uh.. what's the rule here again?
-        try:
-            return self._source.SetField(name, value) #this causes infinite regress because it calls self.fields which triggers getattr
-        except RuntimeError: #ogr gives this for all errors when UseExceptions() is on
+        # fields are set on the feature; anything else is a plain python attribute
+        i = self._field_indexes.get(name)
+        if i is None:
             return object.__setattr__(self, name, value)
+        return self._source.SetField(i, value)
     
     def ExportToJson(self):
         return self._source.ExportToJson()
+
+
+class ColumnarLayer(object):
+    """
+    a layer stored column by column, as a directory of .npy files:
+      columns/<i>.npy: one array per attribute, whose first axis is the features
+      geometry/*.npy:  the arrays of a geometry.Polygons (coordinates and offsets), if the layer has geometry
+      layer.json:      the column names, the feature count, and any other (JSON) metadata
+    Arrays are memory-mapped when they are first asked for, and not before, so opening one is nearly free,
+    only the columns that are used are ever read, and every process that maps the same file shares one
+    page-cached copy of it, without parsing anything.
+    See Layer.to_columnar() for converting a layer.
+    """
+    VERSION = 1
+    GEOMETRY = ["coords", "ring_offsets", "part_offsets", "geometry_offsets"]
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "layer.json")) as f:
+            header = json.load(f)
+        if header["version"] != ColumnarLayer.VERSION:
+            raise ValueError("%s is a version %s ColumnarLayer; this reads version %s" % (path, header["version"], ColumnarLayer.VERSION))
+        self.columns = header["columns"]
+        self.meta = header["meta"]
+        self._length = header["length"]
+        self._has_geometry = header["geometry"]
+        self._arrays = {}
+        self._polygons = None
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def _array(self, name):
+        "memory-map (the first time) the array in file `name`"
+        if name not in self._arrays:
+            # (as a plain ndarray view of the map: indexing a numpy.memmap is many times slower)
+            self._arrays[name] = numpy.asarray(numpy.load(os.path.join(self.path, name + ".npy"), mmap_mode="r"))
+        return self._arrays[name]
+
+    def __getitem__(self, name):
+        "the column `name`"
+        try:
+            i = self.columns.index(name)
+        except ValueError:
+            raise KeyError(name)
+        return self._array("columns/%d" % i)
+
+    @property
+    def polygons(self):
+        "the features' geometry, as a geometry.Polygons over the mapped arrays, or None if we don't have geometry"
+        if self._polygons is None and self._has_geometry:
+            self._polygons = Polygons(*[self._array("geometry/" + name) for name in ColumnarLayer.GEOMETRY])
+        return self._polygons
+
+    @classmethod
+    def write(cls, path, columns, polygons=None, meta=None, exist_ok=False):
+        """
+        write {name: array} `columns` (and a geometry.Polygons, and a dict of JSON-able `meta`) as a ColumnarLayer at `path`, and open it.
+        The directory appears all at once, so readers never see half a layer.
+        A layer already at `path` is replaced, unless exist_ok, in which case it is kept and opened instead
+        (for caches, where another process may have written the same thing first).
+        """
+        names = sorted(columns)
+        lengths = set(len(columns[name]) for name in names)
+        if polygons is not None: lengths.add(len(polygons))
+        if len(lengths) > 1:
+            raise ValueError("Columns have different lengths: %s" % (sorted(lengths),))
+
+        parent = os.path.dirname(os.path.abspath(path))
+        try:
+            os.makedirs(parent)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            os.mkdir(os.path.join(tmp, "columns"))
+            for i, name in enumerate(names):
+                numpy.save(os.path.join(tmp, "columns", "%d.npy" % i), numpy.ascontiguousarray(columns[name]))
+            if polygons is not None:
+                os.mkdir(os.path.join(tmp, "geometry"))
+                for name in cls.GEOMETRY:
+                    numpy.save(os.path.join(tmp, "geometry", name + ".npy"), numpy.ascontiguousarray(getattr(polygons, name)))
+            with open(os.path.join(tmp, "layer.json"), "w") as f:
+                json.dump({"version": cls.VERSION, "columns": names, "length": lengths.pop() if lengths else 0,
+                           "geometry": polygons is not None, "meta": meta or {}}, f)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                if exist_ok or not os.path.isdir(path): raise
+                # move the old layer out of the way first (a rename can't replace a directory that isn't empty)
+                old = tempfile.mkdtemp(dir=parent)
+                os.rename(path, os.path.join(old, "layer"))
+                os.rename(tmp, path)
+                shutil.rmtree(old, ignore_errors=True)
+        except (IOError, OSError):
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not (exist_ok and os.path.isdir(path)): raise #(if it is, another process beat us to it)
+        return cls(path)
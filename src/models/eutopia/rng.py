@@ -0,0 +1,115 @@
+"""
+counter-based random numbers.
+
+A counter-based generator has no state: the number for a given key is a pure function of
+the key, so it can be computed anywhere, in any order, by any process, and come out the same.
+Eutopia keys its draws by (run seed, time, farm id, measure, ...), so each farm's draws for a step
+can be computed on their own, and serial, batched, parallel and replayed runs all agree.
+
+The generator hashes the key with the SplitMix64 finalizer, which is cheap and
+mixes well enough for simulation noise (it is not cryptographic).
+Everything here broadcasts over NumPy arrays, so a whole block of draws is one call.
+"""
+
+import math
+import zlib
+
+import numpy
+
+__all__ = ["key", "digest", "extend", "uniform_of", "normal_of", "uniform", "normal"]
+
+_MASK = 2**64 - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+_M1 = 0xBF58476D1CE4E5B9
+_M2 = 0x94D049BB133111EB
+
+def _mix(z):
+    "the SplitMix64 finalizer, on python ints"
+    z = ((z ^ (z >> 30)) * _M1) & _MASK
+    z = ((z ^ (z >> 27)) * _M2) & _MASK
+    return z ^ (z >> 31)
+
+def _mix_array(z):
+    "the SplitMix64 finalizer, on uint64 arrays (which wrap around by themselves)"
+    z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(_M1)
+    z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(_M2)
+    return z ^ (z >> numpy.uint64(31))
+
+_keys = {}
+_mixed = {} #string keys, and small int keys, already mixed
+def key(value):
+    "turn a key component (an int, a string, or an array of ints) into an int or a uint64 array"
+    "strings are hashed with crc32, which (unlike hash()) is the same in every process"
+    if isinstance(value, basestring):
+        try:
+            return _keys[value]
+        except KeyError:
+            _keys[value] = zlib.crc32(value) & 0xFFFFFFFF
+            _mixed[value] = _mix((_keys[value] + _GOLDEN) & _MASK)
+            return _keys[value]
+    if isinstance(value, numpy.ndarray):
+        return value.astype(numpy.uint64)
+    return int(value) & _MASK
+
+_mixed.update((i, _mix((i + _GOLDEN) & _MASK)) for i in range(256))
+
+def extend(h, *keys):
+    "continue hashing: the hash of (the key that hashed to h) + keys"
+    "the same arithmetic is done on plain ints or, if any component is an array, on uint64 arrays"
+    if not isinstance(h, numpy.ndarray):
+        # scalars: this is on the per-farm loop's hot path, so _mix() is inlined and common keys are premixed
+        h0 = h
+        for k in keys:
+            try:
+                k = _mixed[k]
+            except KeyError:
+                if isinstance(k, numpy.ndarray):
+                    return extend(numpy.asarray(h0, dtype=numpy.uint64), *keys)
+                k = _mix((key(k) + _GOLDEN) & _MASK)
+            except TypeError: #unhashable, ie an array
+                return extend(numpy.asarray(h0, dtype=numpy.uint64), *keys)
+            z = (h + _GOLDEN + k) & _MASK
+            z = ((z ^ (z >> 30)) * _M1) & _MASK
+            z = ((z ^ (z >> 27)) * _M2) & _MASK
+            h = z ^ (z >> 31)
+        return h
+
+    with numpy.errstate(over='ignore'):
+        for k in keys:
+            h = _mix_array(h + numpy.uint64(_GOLDEN) + _mix_array(numpy.asarray(key(k), dtype=numpy.uint64) + numpy.uint64(_GOLDEN)))
+        return h
+
+def digest(*keys):
+    "hash a key to 64 bits (as a python int, or a uint64 array if any component is an array)"
+    "digest(a, b, c) == extend(digest(a, b), c), so shared key prefixes only need hashing once"
+    return extend(0, *keys)
+
+def _uniform(h):
+    "turn 64 hashed bits into a uniform number in (0, 1), keeping 53 bits (as many as a double holds)"
+    if isinstance(h, numpy.ndarray):
+        bits = (h >> numpy.uint64(11)).astype(numpy.float64)
+    else:
+        bits = float(h >> 11)
+    return (bits + 0.5) / 2.0**53
+
+def uniform_of(h):
+    "the uniform number in (0, 1) for a hashed key"
+    return _uniform(extend(h, 0))
+
+def normal_of(h):
+    "the standard normal number for a hashed key"
+    # Box-Muller, on two uniforms derived from the key
+    u1, u2 = _uniform(extend(h, 1)), _uniform(extend(h, 2))
+    if isinstance(h, numpy.ndarray):
+        return numpy.sqrt(-2*numpy.log(u1)) * numpy.cos(2*numpy.pi*u2)
+    # numpy's float64 log and cos call the C library's, as the math module does,
+    # so scalar and array draws agree to the last bit; math's are just much cheaper on one number
+    return math.sqrt(-2*math.log(u1)) * math.cos(2*math.pi*u2)
+
+def uniform(*keys):
+    "the uniform number in (0, 1) for this key; arrays in the key broadcast"
+    return uniform_of(digest(*keys))
+
+def normal(*keys):
+    "the standard normal number for this key; arrays in the key broadcast"
+    return normal_of(digest(*keys))
@@ -0,0 +1,103 @@
+"""
+snapshots of Eutopia's mutable state.
+
+Building a Eutopia means reading the shapefile and wrapping every feature, and none of that
+can be pickled (it holds live ogr handles). But the map never changes during a run; only the
+time, the activities and their prices, the interventions, what each farm is doing and each
+family's bank balance do. snapshot() packs just those into a small compressed string, and
+restore() puts them back into an already-built Eutopia of the same map, which takes
+milliseconds, so scenarios can branch off a shared run instead of replaying it from year 0:
+```{py}
+model = create_demo_model(seed=1)
+for t in range(10): next(model)
+year10 = model.snapshot()
+for variant in variants:
+    model.restore(year10)
+    model.intervene(variant)
+    for t in range(10): next(model)
+```
+Random draws are keyed by (seed, time, ...) (see rng.py), so the seed and the time are all the random
+state there is; a restored run goes on exactly as the original would have.
+The log isn't in the snapshot, but how long it was is: restore() cuts it back to that,
+so that it holds the history of the run it goes on with, not of the branch it abandoned.
+"""
+
+import cPickle as pickle
+import random
+import zlib
+
+import numpy
+
+__all__ = ["snapshot", "restore"]
+
+VERSION = 4 #bump this whenever the snapshot layout changes
+
+def _farm_ids(eutopia):
+    if eutopia.state is not None:
+        return eutopia.state.id
+    return numpy.array([farm.id for farm in eutopia.farms], dtype=numpy.int64)
+
+def _map_key(eutopia):
+    "a checksum of which farms the model has, in which order, so we don't restore a snapshot onto the wrong map"
+    return zlib.crc32(_farm_ids(eutopia).tostring()) & 0xFFFFFFFF
+
+def snapshot(eutopia):
+    "pack eutopia's mutable state into a compressed string; see restore()"
+    codes = eutopia.codes
+    if eutopia.state is not None:
+        activity = eutopia.state.activity
+    else:
+        activity = numpy.array([codes.code(farm.last_activity) for farm in eutopia.farms], dtype=numpy.int16)
+    if eutopia.family_state is not None:
+        balance = eutopia.family_state.balance
+    else:
+        balance = numpy.array([family.bank_balance for family in eutopia.families], dtype=numpy.float64)
+
+    state = {
+        'version': VERSION,
+        'map': _map_key(eutopia),
+        'seed': eutopia.seed,
+        'time': eutopia.time,
+        'log': len(eutopia.log) if eutopia.log is not None else None,
+        'random': random.getstate(), #only used by draws made without a key
+        # pickled together, so that the activities, the intervened-on aggregates, and the
+        # activity codes all still refer to the same objects once they are unpickled
+        'model': (eutopia.activities, list(codes.activities), eutopia.interventions),
+        'activity': activity.astype(numpy.int16).tostring(),
+        'balance': balance.astype(numpy.float64).tostring(),
+    }
+    return zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+def restore(eutopia, data):
+    "put the state that snapshot() packed into `data` back into eutopia, which must have been built on the same map"
+    state = pickle.loads(zlib.decompress(data))
+    if state['version'] != VERSION:
+        raise ValueError("Snapshot is version %s; this Eutopia reads version %s" % (state['version'], VERSION))
+    if state['map'] != _map_key(eutopia):
+        raise ValueError("Snapshot was taken of a different map")
+
+    eutopia.seed = state['seed']
+    eutopia.time = state['time']
+    random.setstate(state['random'])
+    eutopia.activities, activities, eutopia.interventions = state['model']
+    eutopia.codes.replace(activities)
+
+    activity = numpy.fromstring(state['activity'], dtype=numpy.int16)
+    balance = numpy.fromstring(state['balance'], dtype=numpy.float64)
+
+    # write into the existing arrays: the parallel stepper's workers share them
+    if eutopia.state is not None:
+        eutopia.state.activity[:] = activity
+    else:
+        for farm, code in zip(eutopia.farms, activity):
+            farm._last_activity = eutopia.codes[code] #not through the setter: the counts are redone below anyway
+    if eutopia.family_state is not None:
+        eutopia.family_state.balance[:] = balance
+    else:
+        for family, b in zip(eutopia.families, balance):
+            family.bank_balance = b
+
+    eutopia.counts.recount(activity)
+
+    if eutopia.log is not None and state['log'] is not None:
+        del eutopia.log[state['log']:] #(if the log is shorter, eg it was cleared since, there's nothing to cut)
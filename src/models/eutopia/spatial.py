@@ -0,0 +1,51 @@
+"""
+spatial indexing for Eutopia.
+
+Eutopia needs to answer "which farms are nearest to this point?" once for every farm when it loads,
+and sorting every farm by distance for every query makes that O(n^2 log n), which is fine for
+the Elora clip but hopeless for the full ARI province layer. A KD-tree answers the same
+question in O(log n) per query (and O(n log n) to build).
+"""
+
+import numpy
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+__all__ = ["PointIndex", "adjacency_matrix"]
+
+class PointIndex(object):
+    "a k-nearest-neighbours index over a fixed set of 2D points"
+    "points are (x, y) pairs; queries return positions into the sequence the index was built from"
+    def __init__(self, points):
+        self.points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        self._tree = cKDTree(self.points) if len(self.points) else None
+
+    def __len__(self):
+        return len(self.points)
+
+    def nearest(self, x, y, count):
+        "return the indices of the `count` points closest to (x, y), closest first"
+        count = min(count, len(self))
+        if count <= 0:
+            return []
+        _, idx = self._tree.query((x, y), k=count)
+        return numpy.atleast_1d(idx).tolist() #k=1 gives a scalar instead of a list
+
+    def nearest_all(self, count):
+        "for every point in the index, the indices of the `count` points closest to it (itself included)"
+        "this is one bulk query, which is much faster than calling nearest() len(self) times"
+        "returns an (n, count) integer array"
+        count = min(count, len(self))
+        if count <= 0:
+            return numpy.zeros((len(self), 0), dtype=numpy.intp)
+        _, idx = self._tree.query(self.points, k=count)
+        return idx.reshape(len(self), count)
+
+
+def adjacency_matrix(neighbours):
+    "given an (n, k) array where neighbours[i] lists the neighbours of point i (eg from PointIndex.nearest_all()),"
+    "build the sparse (n, n) CSR matrix with a 1 at [i, j] wherever j is one of i's neighbours"
+    neighbours = numpy.asarray(neighbours, dtype=numpy.intp)
+    n, k = neighbours.shape
+    rows = numpy.repeat(numpy.arange(n), k)
+    return scipy.sparse.csr_matrix((numpy.ones(n*k, dtype=numpy.int32), (rows, neighbours.ravel())), shape=(n, n))
@@ -0,0 +1,196 @@
+"""
+columnar (struct-of-arrays) farm state for Eutopia.
+
+Instead of keeping each farm's state on its own Python object, FarmState keeps one
+NumPy array per variable, indexed by the farm's row. Activities are interned to
+small integer codes so that "what is every farm doing" is a single int16 array,
+and counting activities is a single bincount instead of a walk over every Farm.
+"""
+
+import numpy
+import scipy.sparse
+
+__all__ = ["NO_ACTIVITY", "ActivityCodes", "FarmState", "FamilyState", "ActivityCounts"]
+
+NO_ACTIVITY = -1 #the code for a farm which hasn't done anything yet (ie last_activity is None)
+
+class ActivityCodes(object):
+    "interns Activities to small ints (in order of first appearance), and back"
+    def __init__(self):
+        self.activities = [] #code -> Activity
+        self._codes = {}     #name -> code
+
+    def __len__(self):
+        return len(self.activities)
+
+    def code(self, activity):
+        "look up the code for activity, assigning it a new one if we haven't seen it before"
+        if activity is None:
+            return NO_ACTIVITY
+        try:
+            return self._codes[activity.name]
+        except KeyError:
+            self._codes[activity.name] = len(self.activities)
+            self.activities.append(activity)
+            return self._codes[activity.name]
+
+    def replace(self, activities):
+        "re-intern from scratch, so that code i stands for activities[i] (eg when restoring a snapshot)"
+        "this is done in place, since everything that stores codes shares one ActivityCodes"
+        self.activities = []
+        self._codes = {}
+        for activity in activities:
+            self.code(activity)
+
+    def __getitem__(self, code):
+        "look up the Activity for code"
+        if code == NO_ACTIVITY:
+            return None
+        return self.activities[code]
+
+    @property
+    def names(self):
+        return [a.name for a in self.activities]
+
+
+class FarmState(object):
+    "per-farm state as parallel arrays: feature id, centroid x/y, area and activity code, one row per farm"
+    def __init__(self, farms, codes=None):
+        n = len(farms)
+        self.codes = codes if codes is not None else ActivityCodes()
+        self.id = numpy.fromiter((farm.id for farm in farms), dtype=numpy.int64, count=n)
+        self.x = numpy.fromiter((farm.long for farm in farms), dtype=numpy.float64, count=n)
+        self.y = numpy.fromiter((farm.lat for farm in farms), dtype=numpy.float64, count=n)
+        self.area = numpy.fromiter((farm.area for farm in farms), dtype=numpy.float64, count=n)
+        self.activity = numpy.fromiter((self.codes.code(farm.last_activity) for farm in farms), dtype=numpy.int16, count=n)
+        self.family = numpy.fromiter((farm.family.row for farm in farms), dtype=numpy.intp, count=n) #row of each farm's family in the FamilyState
+
+        # hand the farms over to us: from here on their state lives in our arrays
+        # (their families have to have been attached to a FamilyState already)
+        for row, farm in enumerate(farms):
+            farm.attach(self, row)
+
+    def __len__(self):
+        return len(self.activity)
+
+    def get_activity(self, row):
+        return self.codes[self.activity[row]]
+
+    def set_activity(self, row, activity):
+        self.activity[row] = self.codes.code(activity)
+
+    def count(self, rows=None):
+        "histogram of activities, as {name: count}, over every farm or only over the given rows"
+        "farms which have no activity yet are not counted"
+        activity = self.activity if rows is None else self.activity[rows]
+        counts = numpy.bincount(activity[activity != NO_ACTIVITY], minlength=len(self.codes))
+        return dict((self.codes[code].name, int(n)) for code, n in enumerate(counts) if n)
+
+
+class FamilyState(object):
+    "per-family state as parallel arrays: bank balance and preference weights, one row per family"
+    "preferences are snapshotted when the families are attached"
+    def __init__(self, families):
+        n = len(families)
+        self.balance = numpy.fromiter((family.bank_balance for family in families), dtype=numpy.float64, count=n)
+
+        # one column per preference any family has; families without a preference weight it 0
+        self.preferences = []
+        for family in families:
+            for pref in family.preferences:
+                if pref not in self.preferences:
+                    self.preferences.append(pref)
+        self.weights = dict((pref, numpy.fromiter((family.preferences.get(pref, 0) for family in families), dtype=numpy.float64, count=n))
+                            for pref in self.preferences)
+
+        for row, family in enumerate(families):
+            family.attach(self, row)
+
+    def __len__(self):
+        return len(self.balance)
+
+
+class ActivityCounts(object):
+    """
+    activity counts over the whole map and over every farm's neighbourhood,
+    kept up to date incrementally: whenever a farm changes activity, only the
+    counts that farm contributes to are touched, so the cost of keeping count
+    depends on how many farms switched, not on how many farms there are.
+
+    counts are indexed by activity code (see ActivityCodes); columns are added as new activities get interned.
+    """
+    def __init__(self, codes, activity, adjacency):
+        """
+        codes: the ActivityCodes that `activity` is coded with
+        activity: the current activity code of each farm
+        adjacency: (n, n) scipy.sparse neighbour matrix; adjacency[i,j] is 1 if farm j is in farm i's neighbourhood
+        """
+        self.codes = codes
+        self.adjacency = adjacency.tocsr()
+        self._by_member = adjacency.tocsc() #column j lists the neighbourhoods farm j is in
+        self.recount(activity)
+
+    def recount(self, activity):
+        "count from scratch, given the current activity code of each farm"
+        activity = numpy.asarray(activity, dtype=numpy.intp)
+        # every neighbourhood's histogram at once, as one sparse product
+        self.total = numpy.bincount(activity[activity != NO_ACTIVITY], minlength=len(self.codes)).astype(numpy.int64)
+        self.local = numpy.asarray(self.adjacency.dot(self.one_hot(activity)).todense(), dtype=numpy.int32)
+
+    def one_hot(self, codes, value=1):
+        "a sparse (len(codes), activities) CSC matrix with `value` at [i, codes[i]], and empty rows where codes[i] is NO_ACTIVITY"
+        codes = numpy.asarray(codes, dtype=numpy.intp)
+        counted = numpy.flatnonzero(codes != NO_ACTIVITY)
+        return scipy.sparse.csc_matrix((numpy.repeat(value, len(counted)), (counted, codes[counted])), shape=(len(codes), len(self.codes)))
+
+    def grow(self):
+        "add columns for any activities interned since we last looked"
+        extra = len(self.codes) - len(self.total)
+        if extra > 0:
+            self.total = numpy.concatenate([self.total, numpy.zeros(extra, dtype=self.total.dtype)])
+            self.local = numpy.hstack([self.local, numpy.zeros((len(self.local), extra), dtype=self.local.dtype)])
+
+    def change_one(self, row, old, new):
+        "record that the farm at `row` switched from activity code `old` to `new`"
+        "this is change() for a single farm, without the overhead of vectorizing"
+        if old == new:
+            return
+        self.grow()
+        neighbourhoods = self._by_member.indices[self._by_member.indptr[row]:self._by_member.indptr[row+1]] #(a farm is in each neighbourhood at most once)
+        if old != NO_ACTIVITY:
+            self.total[old] -= 1
+            self.local[neighbourhoods, old] -= 1
+        if new != NO_ACTIVITY:
+            self.total[new] += 1
+            self.local[neighbourhoods, new] += 1
+
+    def change(self, rows, old, new):
+        "record that the farms at `rows` switched from activity codes `old` to `new` (all arrays)"
+        self.grow()
+        rows, old, new = (numpy.atleast_1d(numpy.asarray(v, dtype=numpy.intp)) for v in (rows, old, new))
+        switched = old != new
+        rows, old, new = rows[switched], old[switched], new[switched]
+
+        if len(rows) == 0:
+            return
+
+        for codes, delta in ((old, -1), (new, +1)):
+            counted = codes != NO_ACTIVITY
+            numpy.add.at(self.total, codes[counted], delta)
+
+        # the change to every neighbourhood's histogram is one sparse product
+        # of the switched farms' columns of the adjacency matrix with their change in activity
+        change = self._by_member[:, rows].dot(self.one_hot(new) - self.one_hot(old)).tocoo()
+        numpy.add.at(self.local, (change.row, change.col), change.data.astype(self.local.dtype))
+
+    def as_dict(self, counts):
+        "turn a row of counts (by activity code) into {name: count}"
+        return dict((self.codes[code].name, int(n)) for code, n in enumerate(counts) if n)
+
+    def count(self):
+        "the activity histogram over the whole map, as {name: count}"
+        return self.as_dict(self.total)
+
+    def local_count(self, row):
+        "the activity histogram over the neighbourhood of the farm at `row`, as {name: count}"
+        return self.as_dict(self.local[row])
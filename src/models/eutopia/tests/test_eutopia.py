@@ -0,0 +1,70 @@
+import unittest
+import sys
+from os.path import dirname, realpath
+
+cwd = dirname(dirname(dirname(realpath(__file__))))
+sys.path.append(cwd)
+
+import numpy
+
+import eutopia
+from eutopia.world import World
+from eutopia.spatial import PointIndex
+
+FARMS = 300
+STEPS = 10 #long enough for create_demo_model()'s interventions (at steps 5 and 7) to kick in
+
+def synthetic_world(path, codes, neighbourhood_size, cache=None):
+    "a World of FARMS farms scattered at random, standing in for World.load(), so the tests don't need the shapefile"
+    rs = numpy.random.RandomState(0)
+    x, y = rs.uniform(0, 10000, (2, FARMS))
+    arrays = {'id': numpy.arange(FARMS),
+              'map_code': numpy.array(sorted(codes))[rs.randint(len(codes), size=FARMS)],
+              'x': x, 'y': y,
+              'area': rs.uniform(1e4, 1e6, FARMS),
+              'neighbours': PointIndex(numpy.column_stack([x, y])).nearest_all(neighbourhood_size).astype(numpy.int32)}
+    return World(path, arrays, ['MAP_CODE'], FARMS)
+
+def history(model, steps):
+    "the name of every farm's activity after each of `steps` steps"
+    "(names, since each model has its own Activity objects)"
+    activities = []
+    for t in range(steps):
+        next(model)
+        activities.append([getattr(farm.last_activity, 'name', None) for farm in model.farms])
+    return activities
+
+class EutopiaCase(unittest.TestCase):
+    def setUp(self):
+        self.load = World.__dict__['load']
+        World.load = staticmethod(synthetic_world)
+
+    def tearDown(self):
+        World.load = self.load
+
+    def run_model(self, **options):
+        with eutopia.create_demo_model(seed=7, cache=None, **options) as model:
+            return history(model, STEPS)
+
+    def test_engines_agree(self):
+        "the serial, columnar, batched and parallel engines are different ways of making the same decisions"
+        serial = self.run_model()
+        self.assertEqual(self.run_model(columnar=True), serial)
+        self.assertEqual(self.run_model(batch=True), serial)
+        self.assertEqual(self.run_model(processes=2), serial)
+
+    def test_snapshot_replay(self):
+        "restoring a snapshot and stepping on from it repeats what happened after it was taken"
+        for options in [{}, {'batch': True}]:
+            with eutopia.create_demo_model(seed=7, cache=None, **options) as model:
+                history(model, 4)
+                snapshot = model.snapshot()
+                after = history(model, STEPS - 4)
+                log = model.log[:]
+                model.restore(snapshot)
+                self.assertEqual(len(model.log), 4) #the abandoned steps are cut from the log
+                self.assertEqual(history(model, STEPS - 4), after)
+                self.assertEqual(model.log[:], log)
+
+if __name__ == '__main__':
+    unittest.main()
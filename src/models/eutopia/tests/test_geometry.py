@@ -0,0 +1,69 @@
+import unittest
+import sys
+import struct
+from os.path import dirname, realpath
+
+cwd = dirname(dirname(realpath(__file__)))
+sys.path.append(cwd) #(the modules themselves, which don't need GDAL, unlike the eutopia package)
+
+import numpy
+
+from geometry import Polygons
+
+def box(x0, y0, x1, y1, clockwise=False):
+    "a closed ring around the box"
+    ring = [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+    return ring[::-1] if clockwise else ring
+
+def polygon_wkb(rings, endian="<", z=False):
+    "WKB for a Polygon with these rings (the first is the shell)"
+    type = 1003 if z else 3
+    wkb = struct.pack(endian + "BII", 1 if endian == "<" else 0, type, len(rings))
+    for ring in rings:
+        wkb += struct.pack(endian + "I", len(ring))
+        for x, y in ring:
+            wkb += struct.pack(endian + ("ddd" if z else "dd"), *((x, y, 7.0) if z else (x, y)))
+    return wkb
+
+def multipolygon_wkb(polygons, endian="<"):
+    return struct.pack(endian + "BII", 1 if endian == "<" else 0, 6, len(polygons)) + "".join(polygon_wkb(rings, endian) for rings in polygons)
+
+class PolygonsCase(unittest.TestCase):
+    def setUp(self):
+        self.polygons = Polygons.from_wkb([
+            polygon_wkb([box(0, 0, 10, 10)]),
+            polygon_wkb([box(0, 0, 10, 10), box(2, 2, 4, 4)]),                   #a hole...
+            polygon_wkb([box(0, 0, 10, 10, clockwise=True), box(2, 2, 4, 4)]),  #...whichever way the rings are wound
+            multipolygon_wkb([[box(0, 0, 10, 10)], [box(20, 0, 22, 2)]]),
+            None,                                                                #no geometry
+            polygon_wkb([box(0, 0, 10, 10)], endian=">", z=True),                #big-endian, with Z (which is dropped)
+            polygon_wkb([box(5e6, 5e6, 5e6 + 10, 5e6 + 10)]),                    #far from the origin, as map units are
+        ])
+
+    def test_layout(self):
+        self.assertEqual(len(self.polygons), 7)
+        self.assertEqual(list(numpy.diff(self.polygons.geometry_offsets)), [1, 1, 1, 2, 0, 1, 1]) #parts per geometry
+        self.assertEqual(self.polygons.coords.shape[1], 2)
+
+    def test_areas(self):
+        numpy.testing.assert_allclose(self.polygons.areas(), [100, 96, 96, 104, 0, 100, 100])
+
+    def test_centroids(self):
+        centroids = self.polygons.centroids()
+        hole = (100*5 - 4*3) / 96.0
+        expected = [(5, 5), (hole, hole), (hole, hole), ((100*5 + 4*21) / 104.0, (100*5 + 4*1) / 104.0)]
+        numpy.testing.assert_allclose(centroids[:4], expected)
+        self.assertTrue(numpy.isnan(centroids[4]).all())
+        numpy.testing.assert_allclose(centroids[5:], [(5, 5), (5e6 + 5, 5e6 + 5)], rtol=0, atol=1e-6)
+
+    def test_bounds(self):
+        bounds = self.polygons.bounds()
+        numpy.testing.assert_allclose(bounds[[0, 1, 3, 5]], [(0, 0, 10, 10), (0, 0, 10, 10), (0, 0, 22, 10), (0, 0, 10, 10)])
+        self.assertTrue(numpy.isnan(bounds[4]).all())
+
+    def test_not_polygons(self):
+        point = struct.pack("<BIdd", 1, 1, 0.0, 0.0)
+        self.assertRaises(ValueError, Polygons.from_wkb, [point])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import sys
+from os.path import dirname, realpath
+
+cwd = dirname(dirname(realpath(__file__)))
+sys.path.append(cwd) #(the modules themselves, which don't need GDAL, unlike the eutopia package)
+
+import numpy
+
+from intervention import Schedule, PriceIntervention
+
+PRODUCTS = ['duramSeed', 'duramSeedOrganic']
+STEPS = 15
+
+class Activities(object):
+    "just the prices, which is all PriceIntervention touches"
+    def __init__(self):
+        self.aggregates = {'money': dict((product, 50.0) for product in PRODUCTS)}
+
+    def set_measure(self, measure, product, value):
+        self.aggregates[measure][product] = value
+
+class Model(object):
+    def __init__(self):
+        self.activities = Activities()
+
+def prices(model):
+    return [model.activities.aggregates['money'][product] for product in PRODUCTS]
+
+def old_loop(specs):
+    "the prices after each step, applying every intervention that has started every step, in the order they were added, as Eutopia used to"
+    model, interventions = Model(), []
+    history = []
+    for time in range(1, STEPS + 1):
+        interventions.extend(PriceIntervention(*args) for added, args in specs if added == time)
+        for intervention in interventions:
+            if time >= intervention.time:
+                intervention.apply(model, time)
+        history.append(prices(model))
+    return history
+
+def scheduled(specs):
+    "the prices after each step, through a Schedule, as Eutopia does now; and the Schedule"
+    model, schedule = Model(), Schedule()
+    history = []
+    for time in range(1, STEPS + 1):
+        for added, args in specs:
+            if added == time:
+                schedule.add(PriceIntervention(*args))
+        schedule.apply(model, time)
+        history.append(prices(model))
+    return history, schedule
+
+class ScheduleCase(unittest.TestCase):
+    def test_last_added_wins(self):
+        "an intervention added later wins, even when it starts first"
+        specs = [(1, (5, 'duramSeed', 10)), (1, (3, 'duramSeed', 2))]
+        history, schedule = scheduled(specs)
+        self.assertEqual(history, old_loop(specs))
+        self.assertEqual(history[-1][0], 100.0)
+        self.assertEqual(len(schedule), 0) #and once nothing can override it, everything is retired
+
+    def test_same_as_old_loop(self):
+        "overlapping, phased-in and late-added interventions on the same products give the same prices as applying them all every step"
+        rs = numpy.random.RandomState(0)
+        for scenario in range(300):
+            specs = []
+            for i in range(rs.randint(1, 6)):
+                added = 1 if rs.rand() < 0.5 else rs.randint(1, STEPS) #some are added while the model runs
+                time = rs.randint(added if rs.rand() < 0.5 else 1, STEPS) #(and some of those start in the past)
+                phase_in = rs.choice([0, 0, 2, 4])
+                specs.append((added, (time, PRODUCTS[rs.randint(len(PRODUCTS))], round(rs.uniform(0.1, 10), 2), phase_in)))
+            history, schedule = scheduled(specs)
+            self.assertEqual(history, old_loop(specs), specs)
+            if max(args[0] + args[3] for _, args in specs) < STEPS:
+                self.assertEqual(len(schedule), 0, specs)
+
+if __name__ == '__main__':
+    unittest.main()
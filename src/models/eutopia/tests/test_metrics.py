@@ -0,0 +1,71 @@
+import unittest
+import sys
+import shutil
+import tempfile
+from os.path import dirname, realpath
+
+cwd = dirname(dirname(realpath(__file__)))
+sys.path.append(cwd) #(the modules themselves, which don't need GDAL, unlike the eutopia package)
+
+import numpy
+
+from metrics import MetricsLog
+
+STEPS = 50
+
+def entries(seed=0):
+    "STEPS log entries, (time, {metric: count}), with metrics coming and going and some zeros left out"
+    rs = numpy.random.RandomState(seed)
+    names = ['m%d' % i for i in range(6)]
+    return [(time, dict((names[i], int(rs.randint(1, 100))) for i in rs.choice(len(names), rs.randint(0, 4), replace=False)))
+            for time in range(1, STEPS + 1)]
+
+class MetricsLogCase(unittest.TestCase):
+    def setUp(self):
+        self.spill = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill, ignore_errors=True)
+
+    def logs(self):
+        "a log that keeps everything in memory, and ones that spill after a few rows"
+        return [MetricsLog(), MetricsLog(limit=3, spill=self.spill + "/3"), MetricsLog(limit=7, spill=self.spill + "/7")]
+
+    def test_like_a_list(self):
+        log = entries()
+        for metrics in self.logs():
+            metrics.extend(log)
+            self.assertEqual(len(metrics), len(log))
+            self.assertEqual(list(metrics), log)
+            self.assertEqual(metrics[-1], log[-1])
+            self.assertEqual(metrics[10], log[10])
+            self.assertEqual(metrics[5:40], log[5:40])
+            self.assertEqual(metrics[::7], log[::7])
+            self.assertRaises(IndexError, lambda: metrics[STEPS])
+
+    def test_series_and_between(self):
+        log = entries()
+        for metrics in self.logs():
+            metrics.extend(log)
+            for name in metrics.names + ['never']:
+                self.assertEqual(list(metrics.series(name)), [counts.get(name, 0) for _, counts in log])
+            times, values = metrics.between(10, 20)
+            self.assertEqual(list(times), range(10, 20))
+            self.assertEqual([dict((name, v) for name, v in zip(metrics.names, row) if v) for row in values],
+                             [counts for time, counts in log if 10 <= time < 20])
+
+    def test_truncate(self):
+        "del log[n:] drops rows from n on, wherever they are (eg for snapshot.restore()), and the log carries on from there"
+        log, more = entries(0), entries(1)
+        for n in [0, 2, 5, 20, STEPS, STEPS + 5]:
+            for metrics in self.logs():
+                metrics.extend(log)
+                del metrics[n:]
+                self.assertEqual(list(metrics), log[:n])
+                metrics.extend(more)
+                self.assertEqual(list(metrics), log[:n] + more)
+                del metrics[:]
+                self.assertEqual(len(metrics), 0)
+
+if __name__ == '__main__':
+    unittest.main()
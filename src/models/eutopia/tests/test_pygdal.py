@@ -0,0 +1,58 @@
+import unittest
+import sys
+from os.path import dirname, realpath
+
+cwd = dirname(dirname(realpath(__file__)))
+sys.path.append(cwd)
+
+import ogr
+
+from pygdal import Layer, sql_literal
+
+FARMS = [('C', 10), ('C', 20), ('B', 30), ('G', 40), ("O'K", 50)] #(MAP_CODE, AREA) of each feature
+
+class SQLLiteralCase(unittest.TestCase):
+    def test_strings(self):
+        self.assertEqual(sql_literal('C'), "'C'")
+        self.assertEqual(sql_literal(u'C'), "'C'")
+        self.assertEqual(sql_literal("O'K"), "'O''K'")
+
+    def test_numbers(self):
+        self.assertEqual(sql_literal(5), "5")
+        self.assertEqual(sql_literal(5L), "5") #not 5L
+        self.assertEqual(sql_literal(0.1), "0.1")
+        self.assertEqual(float(sql_literal(1/3.0)), 1/3.0) #not rounded
+
+class WhereCase(unittest.TestCase):
+    def setUp(self):
+        # an in-memory layer (kept alive through self.source, which owns it)
+        self.source = ogr.GetDriverByName('Memory').CreateDataSource('test')
+        layer = self.source.CreateLayer('farms', geom_type=ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn('MAP_CODE', ogr.OFTString))
+        layer.CreateField(ogr.FieldDefn('AREA', ogr.OFTInteger))
+        for code, area in FARMS:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('MAP_CODE', code)
+            feature.SetField('AREA', area)
+            layer.CreateFeature(feature)
+        self.layer = Layer(layer)
+
+    def test_clauses(self):
+        self.assertEqual(self.layer.where(MAP_CODE='C')._where, "MAP_CODE = 'C'")
+        self.assertEqual(self.layer.where(MAP_CODE=['C', 'B'])._where, "MAP_CODE IN ('C', 'B')")
+        self.assertEqual(self.layer.where(MAP_CODE=[])._where, "1=0")
+        self.assertEqual(self.layer.where("AREA > 15", AREA=[20L, 30])._where, "(AREA > 15) AND (AREA IN (20, 30))")
+        self.assertEqual(self.layer.where(MAP_CODE='C').where(AREA=10)._where, "(MAP_CODE = 'C') AND (AREA = 10)")
+
+    def test_counts(self):
+        self.assertEqual(len(self.layer), len(FARMS))
+        self.assertEqual(len(self.layer.where(MAP_CODE='C')), 2)
+        self.assertEqual(len(self.layer.where(MAP_CODE=["C", "O'K"])), 3)
+        self.assertEqual(len(self.layer.where(MAP_CODE=[])), 0)
+        self.assertEqual(len(self.layer.where("AREA > 15", MAP_CODE=set(['C', 'G']))), 2)
+        self.assertEqual(len(self.layer.where(AREA=[10L, 50])), 2)
+        self.assertEqual(len(self.layer.where(MAP_CODE='C').where(AREA=20)), 1)
+        self.assertEqual(len(self.layer), len(FARMS)) #(views don't leave their filters on the layer they share)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,18 +5,49 @@ TODO: put this module somewhere more generic, like com.sig.modex or SIG.modellin
 """
 
 import warnings
+import weakref
+from collections import OrderedDict, namedtuple
 
-__all__ = ["memoize"]
+__all__ = ["memoize", "cached_property", "cache_stats"]
 
-def memoize(f):
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"]) #as in py3's functools
+
+_caches = weakref.WeakSet() #every memoize()d function and cached_property, for cache_stats(); weakly, so that they (and what they cache) are still freed
+
+def cache_stats():
+    "{name: CacheInfo} for every live cache made with memoize() or cached_property, to see which of them pay off"
+    "caches with the same name (eg from memoize()ing in a function that is called more than once) are added up"
+    stats = {}
+    for cache in list(_caches):
+        info = cache.cache_info()
+        if cache.cache_name in stats:
+            other = stats[cache.cache_name]
+            info = CacheInfo(info.hits + other.hits, info.misses + other.misses, info.maxsize,
+                             None if info.currsize is None else info.currsize + other.currsize)
+        stats[cache.cache_name] = info
+    return stats
+
+def memoize(f=None, maxsize=None):
     """
     a decorators that memoizes (ie caches) the results from f.
-    f will only be called once for each combination of arguments.
-    
+    f will only be called once for each combination of arguments,
+    or, given maxsize, the least recently used results are dropped once there are more than maxsize of them:
+      @memoize
+      def f(...): ...
+      @memoize(maxsize=1000)
+      def g(...): ...
+    f.cache_info() gives the hit and miss counts, and f.cache_clear() empties the cache.
+
     arguments to f must be hashable.
      So, memoize() does not support keyword arguments.
+    The cache holds on to its arguments, so don't memoize methods with it (the cache would keep every
+    instance alive): use cached_property, which keeps the value on the instance, instead.
     """
-    cache = {}
+    if f is None: #called as @memoize(maxsize=...)
+        return lambda f: memoize(f, maxsize)
+
+    # only a bounded cache needs to track the order of use, which costs a pop and an insert on every hit
+    cache = {} if maxsize is None else OrderedDict() #(the OrderedDict in order of use, least recent first)
     def f2(*args, **kwargs):
         if kwargs:
             warnings.warn("memoize() does not support keyword arguments")
@@ -25,6 +56,70 @@ def memoize(f):
             # we can cache on args, so long as they are simple args,
             # because the *args syntax gives tuples which are hashable
             # if all their components are hashable
-            if args not in cache: cache[args] = f(*args) 
-            return cache[args]
-    return f2 
+            if maxsize is None:
+                try:
+                    value = cache[args]
+                    f2.hits += 1
+                except KeyError:
+                    f2.misses += 1
+                    value = cache[args] = f(*args)
+                return value
+            try:
+                value = cache.pop(args)
+                f2.hits += 1
+            except KeyError:
+                f2.misses += 1
+                value = f(*args)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[args] = value #(re)insert as the most recently used
+            return value
+
+    def cache_info():
+        return CacheInfo(f2.hits, f2.misses, maxsize, len(cache))
+    def cache_clear():
+        cache.clear()
+        f2.hits = f2.misses = 0
+
+    f2.hits = f2.misses = 0
+    f2.cache_info = cache_info
+    f2.cache_clear = cache_clear
+    f2.__name__, f2.__doc__ = f.__name__, f.__doc__
+    f2.cache_name = f.__module__ + "." + f.__name__
+    _caches.add(f2)
+    return f2
+
+class cached_property(object):
+    """
+    a property that is computed the first time it is read and then stored on the instance,
+    so the cached value lives (and dies) with the instance, and reading it again doesn't hash anything.
+    Assigning to it sets the value; deleting it makes the next read compute it again.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.name = f.__name__
+        self.__doc__ = f.__doc__
+        self.hits = self.misses = 0
+        self.cache_name = f.__module__ + "." + f.__name__
+        _caches.add(self)
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            value = obj.__dict__[self.name]
+        except KeyError:
+            self.misses += 1
+            value = obj.__dict__[self.name] = self.f(obj)
+            return value
+        self.hits += 1
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+    def __delete__(self, obj):
+        obj.__dict__.pop(self.name, None)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, None, None) #(the values are spread over the instances, so there's no one size)
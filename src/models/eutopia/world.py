@@ -0,0 +1,139 @@
+"""
+the static data Eutopia derives from its map, cached on disk.
+
+Getting from the shapefile to the farms means unzipping it, walking every feature through GDAL,
+keeping the agricultural ones, and finding every farm's centroid, area and neighbours, which takes
+seconds to minutes depending on the map. None of it changes unless the map does, so World.load()
+keeps the results in a cache directory, keyed by a hash of the shapefile's contents (and of the
+settings they were derived with), as a pygdal.ColumnarLayer, which is memory-mapped back in.
+A warm start does not touch GDAL at all; each Farm only loads its feature if something asks for
+its fields or its geometry (see World.map).
+"""
+
+import hashlib
+import json
+import os
+
+import numpy
+
+from pygdal import Shapefile, ColumnarLayer, wkbPolygon, invertOGRConstant
+from spatial import PointIndex
+from util import cached_property, memoize
+
+__all__ = ["World"]
+
+VERSION = 3 #bump this whenever what World stores, or how it is derived, changes; old caches are then ignored
+
+ARRAYS = ["id", "map_code", "x", "y", "area", "neighbours"]
+
+def _files(path):
+    "the file at `path`, or every file under it, if it is a directory"
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, f) for root, _, files in os.walk(path) for f in files)
+    return [path]
+
+def digest_file(path, chunk=1<<20):
+    "sha1 of the contents of the file at `path`, or of every file under it, if it is a directory"
+    h = hashlib.sha1()
+    names = _files(path)
+    for name in names:
+        h.update(os.path.relpath(name, path))
+        with open(name, "rb") as f:
+            for block in iter(lambda: f.read(chunk), b""):
+                h.update(block)
+    return h.hexdigest()
+
+@memoize(maxsize=16)
+def _digest(path, stamp):
+    return digest_file(path)
+
+def cached_digest(path):
+    """
+    digest_file(path), only reading the file(s) again once they have changed (by their sizes and mtimes) in this process.
+    Every Eutopia() asks for it (eg every ensemble replicate), and reading a big map through sha1 takes seconds.
+    """
+    path = os.path.abspath(path)
+    return _digest(path, tuple((name, os.path.getsize(name), os.path.getmtime(name)) for name in _files(path)))
+
+class World(object):
+    """
+    per-farm static data, as parallel arrays with one row per farm:
+      id:         the farm's feature id in the map layer
+      map_code:   its land use code (see eutopia.AGRICULTURE_CODES)
+      x, y:       its centroid
+      area:       its area
+      neighbours: (farms, neighbourhood_size) rows of the farms nearest to it, nearest (ie itself) first
+    and, about the map:
+      fields:     the names of the layer's fields
+      features:   how many features the layer has in total
+    """
+    def __init__(self, path, arrays, fields, features):
+        self.path = path #the shapefile, for loading the map itself if it's needed
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.fields = fields
+        self.field_indexes = dict((name, i) for i, name in enumerate(fields)) #as pygdal.field_indexes() gives them
+        self.features = features
+
+    def __len__(self):
+        return len(self.id)
+
+    @cached_property
+    def map(self):
+        "the map layer the farms are features of; it is only opened the first time it is asked for"
+        map = Shapefile(self.path)[0] #cheating: assume the only layer we care about is this one (it keeps its Shapefile alive through .parent)
+        assert map.GetGeomType() == wkbPolygon, "Farm boundaries layer is not a Polygon; it is a" + str.join(" or ", invertOGRConstant(map.GetGeomType()))
+        #assert isinstance(self.map, PolygonLayer), "Farm boundaries layer is not a Polygon; it is a " + str(type(self.map))
+        return map
+
+    @classmethod
+    def build(cls, path, codes, neighbourhood_size):
+        "derive the world from the shapefile at `path` (with GDAL), keeping features whose MAP_CODE is in `codes`"
+        world = cls(path, dict((name, None) for name in ARRAYS), [], 0)
+        layer = world.map
+
+        world.field_indexes = layer.field_indexes
+        world.fields = sorted(world.field_indexes, key=world.field_indexes.get)
+        world.features = len(layer)
+
+        # one pass over the farms (OGR does the filtering), then one vectorized pass over their polygons
+        farms = layer.where(MAP_CODE=sorted(codes)).to_columns(["MAP_CODE"], fid=True, geometry=True)
+        world.id = farms["FID"]
+        world.map_code = farms["MAP_CODE"]
+        world.x, world.y = farms["geometry"].centroids().T
+        world.area = farms["geometry"].areas()
+        world.neighbours = PointIndex(numpy.column_stack([world.x, world.y])).nearest_all(neighbourhood_size).astype(numpy.int32)
+        return world
+
+    @classmethod
+    def load(cls, path, codes, neighbourhood_size, cache=None):
+        """
+        the world for the shapefile at `path`: from `cache` (a directory) if it has it, otherwise built and then saved there.
+        cache=None means don't cache.
+        """
+        if cache is None:
+            return cls.build(path, codes, neighbourhood_size)
+
+        key = hashlib.sha1(json.dumps([VERSION, cached_digest(path), sorted(codes), neighbourhood_size])).hexdigest()
+        where = os.path.join(cache, key)
+        try:
+            return cls.read(path, where)
+        except (IOError, OSError, ValueError):
+            pass
+
+        world = cls.build(path, codes, neighbourhood_size)
+        try:
+            world.write(where)
+        except (IOError, OSError):
+            pass #a read-only cache just means cold starts
+        return world
+
+    @classmethod
+    def read(cls, path, where):
+        "load a world write() wrote to directory `where`, memory-mapping its arrays"
+        store = ColumnarLayer(where)
+        return cls(path, dict((name, store[name]) for name in ARRAYS), store.meta["fields"], store.meta["features"])
+
+    def write(self, where):
+        "save to directory `where`"
+        ColumnarLayer.write(where, dict((name, getattr(self, name)) for name in ARRAYS), meta={"fields": self.fields, "features": self.features}, exist_ok=True)